@@ -0,0 +1,268 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os, sys, json, time, shutil, argparse, platform, resource, subprocess, tempfile
+import numpy as np
+import mxnet as mx
+
+from mxnet import nd
+from mxnet import autograd
+from mxnet import gluon
+
+MODELS = ('vgg10', 'resnet_head', 'resnet', 'resnet18')
+STAGES = ('read_json', 'build_cache', 'read_cache', 'augment', 'loader') + \
+    tuple('fwd_bwd_' + m for m in MODELS) + ('predict',)
+
+
+def gen_synthetic(path, n, labeled=True, seed=0, na_rate=0.08):
+    """write `n` fake SAR chips in the Kaggle train/test.json schema. Chips are
+    dB-scaled speckle with one bright target; records are streamed out so
+    memory does not grow with n"""
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[:75, :75]
+    with open(path, 'w') as f:
+        f.write('[')
+        for i in range(n):
+            label = int(rng.rand() < .47)
+            cy, cx = rng.uniform(25, 50, size=2)
+            r = rng.uniform(2, 6) * (1.5 if label else 1.)
+            blob = np.exp(-((yy - cy) ** 2 + (xx - cx) ** 2) / (2 * r * r))
+            rec = {'id': '%08x' % rng.randint(1 << 31)}
+            for b, (base, gain) in enumerate(((-22., 25.), (-28., 15.))):
+                band = base + gain * blob + rng.normal(0, 3., size=(75, 75))
+                rec['band_%d' % (b + 1)] = np.round(band, 4).ravel().tolist()
+            angle = round(float(rng.uniform(30, 46)), 4)
+            rec['inc_angle'] = 'na' if labeled and rng.rand() < na_rate else angle
+            if labeled:
+                rec['is_iceberg'] = label
+            f.write((', ' if i else '') + json.dumps(rec))
+        f.write(']')
+
+
+def _peak_rss_mb():
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_kb / 1024., child_kb / 1024.
+
+
+def _model(name, ctx):
+    """(block, forward(x, angle)) for one of MODELS, initialized on ctx"""
+    if name == 'vgg10':
+        from train import Net_vgg10
+        net = Net_vgg10()
+    elif name == 'resnet':
+        import resnet
+        net = resnet.Resnet()
+    elif name == 'resnet18':
+        import utils
+        net = utils.resnet18(2)
+    elif name == 'resnet_head':
+        import resnet
+        return resnet.net, lambda x, angle: resnet.add_angle(resnet.net(x), angle)
+    net.initialize(ctx=ctx)
+    return net, lambda x, angle: net(x)
+
+
+def _load_train(data):
+    from train import read_src_data
+    ds, labels = read_src_data(path=os.path.join(data, 'train.json'))
+    return ds.astype('float32'), nd.array(np.asarray(labels)).astype('float32')
+
+
+def run_stage(name, args):
+    """time one stage in this process and return its result dict"""
+    import utils, train
+    ctx = mx.cpu()
+    train_json = os.path.join(args.data, 'train.json')
+    test_json = os.path.join(args.data, 'test.json')
+    extra = {}
+    stop = None
+
+    if name == 'read_json':
+        start = time.time()
+        ds, _ = train.read_src_data(path=train_json, cache=False)
+        ds.wait_to_read()
+        n = ds.shape[0]
+    elif name == 'build_cache':
+        tmp = tempfile.mkdtemp()
+        start = time.time()
+        cache_dir = utils.build_src_cache(train_json, os.path.join(tmp, 'train.cache'))
+        stop = time.time()
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            n = json.load(f)['n']
+        shutil.rmtree(tmp)
+    elif name == 'read_cache':
+        utils.load_src_data(train_json)
+        start = time.time()
+        ds, _ = train.read_src_data(path=train_json, cache=True)
+        ds.wait_to_read()
+        n = ds.shape[0]
+    elif name == 'augment':
+        ds, labels = _load_train(args.data)
+        x, y = ds[:args.aug_chips], labels[:args.aug_chips]
+        start = time.time()
+        out, _ = train.augment_data(x, y)
+        out.wait_to_read()
+        n = x.shape[0]
+        extra['copies'] = out.shape[0] // n
+    elif name == 'loader':
+        ds, labels = _load_train(args.data)
+        loader = utils.DataLoader((utils.to_nchw(ds), labels), args.batch_size,
+                                  augs=utils.online_augs('NCHW'), num_workers=args.num_workers,
+                                  layout='NCHW')
+        start = time.time()
+        n = 0
+        for data, label in loader:
+            data.wait_to_read()
+            n += data.shape[0]
+        loader.close()
+        extra['num_workers'] = args.num_workers
+    elif name.startswith('fwd_bwd_'):
+        net, forward = _model(name[len('fwd_bwd_'):], ctx)
+        if args.hybridize:
+            net.hybridize()
+        loss_fn = gluon.loss.SoftmaxCrossEntropyLoss()
+        x = nd.random.uniform(shape=(args.batch_size, 2, 75, 75), ctx=ctx)
+        y = nd.array(np.random.randint(0, 2, args.batch_size), ctx=ctx)
+        angle = nd.random.uniform(1, 2, shape=(args.batch_size,), ctx=ctx)
+        for i in range(args.warmup + args.batches):
+            if i == args.warmup:
+                nd.waitall()
+                start = time.time()
+            with autograd.record():
+                loss = loss_fn(forward(x, angle), y)
+            loss.backward()
+        nd.waitall()
+        n = args.batches * args.batch_size
+        extra['hybridize'] = args.hybridize
+    elif name == 'predict':
+        test, ids = train.read_src_data(False, path=test_json)
+        test_ds = (utils.to_nchw(utils.batch_img_norm(test.astype('float32'))), ids)
+        test_data = utils.TestDataLoader(test_ds, args.batch_size, layout='NCHW')
+        net, _ = _model('vgg10', ctx)
+        if args.hybridize:
+            net.hybridize()
+        with tempfile.NamedTemporaryFile(suffix='.csv') as out:
+            start = time.time()
+            utils.predict(test_data, net, out.name, ctx)
+        n = test_ds[0].shape[0]
+    else:
+        raise ValueError('unknown stage %r' % name)
+
+    seconds = (stop or time.time()) - start
+    rss, child_rss = _peak_rss_mb()
+    result = {'stage': name, 'chips': n, 'seconds': seconds,
+              'chips_per_sec': n / seconds, 'peak_rss_mb': rss, 'peak_child_rss_mb': child_rss}
+    result.update(extra)
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """run every stage in a fresh process so peak RSS is per stage"""
+    results = []
+    for name in args.stages:
+        cmd = [sys.executable, os.path.abspath(__file__), 'stage', name, '--data', args.data,
+               '--batch-size', str(args.batch_size), '--batches', str(args.batches),
+               '--warmup', str(args.warmup), '--aug-chips', str(args.aug_chips),
+               '--num-workers', str(args.num_workers)]
+        if args.hybridize:
+            cmd.append('--hybridize')
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE)
+        if proc.returncode != 0:
+            print('%-20s failed (exit %d)' % (name, proc.returncode))
+            results.append({'stage': name, 'error': proc.returncode})
+            continue
+        res = json.loads(proc.stdout.decode().strip().splitlines()[-1])
+        print('%-20s %10.1f chips/s %8.2f s %9.1f MB' % (
+            name, res['chips_per_sec'], res['seconds'], res['peak_rss_mb']))
+        sys.stdout.flush()
+        results.append(res)
+    return {'commit': _git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': platform.node(), 'cpus': os.cpu_count(), 'mxnet': mx.__version__,
+            'data': os.path.abspath(args.data), 'batch_size': args.batch_size,
+            'results': results}
+
+
+def compare(old, new, threshold):
+    """print per-stage throughput ratios; returns the stages slower than threshold"""
+    before = dict((r['stage'], r) for r in old['results'] if 'error' not in r)
+    slower = []
+    print('%-20s %12s %12s %8s %10s' % ('stage', old['commit'], new['commit'], 'ratio', 'rss delta'))
+    for r in new['results']:
+        if 'error' in r or r['stage'] not in before:
+            continue
+        b = before[r['stage']]
+        ratio = r['chips_per_sec'] / b['chips_per_sec']
+        print('%-20s %12.1f %12.1f %7.2fx %+9.1fM' % (
+            r['stage'], b['chips_per_sec'], r['chips_per_sec'], ratio,
+            r['peak_rss_mb'] - b['peak_rss_mb']))
+        if ratio < 1 - threshold:
+            slower.append(r['stage'])
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the data, training and inference stages')
+    sub = parser.add_subparsers(dest='cmd')
+
+    p = sub.add_parser('gen', help='write synthetic train.json/test.json')
+    p.add_argument('--out', default='./bench_data')
+    p.add_argument('--train', type=int, default=1604, help='labeled chips')
+    p.add_argument('--test', type=int, default=8424, help='unlabeled chips')
+    p.add_argument('--seed', type=int, default=0)
+
+    for name in ('run', 'stage'):
+        p = sub.add_parser(name)
+        if name == 'stage':
+            p.add_argument('name', choices=STAGES)
+        else:
+            p.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+            p.add_argument('-o', '--output', help='write the results as JSON here')
+        p.add_argument('--data', default='./bench_data')
+        p.add_argument('--batch-size', type=int, default=128)
+        p.add_argument('--batches', type=int, default=10, help='timed batches per model')
+        p.add_argument('--warmup', type=int, default=2)
+        p.add_argument('--aug-chips', type=int, default=256, help='chips fed to augment_data')
+        p.add_argument('--num-workers', type=int, default=0)
+        p.add_argument('--hybridize', action='store_true')
+
+    p = sub.add_parser('compare', help='compare two result files')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='exit 1 if a stage lost more than this fraction of throughput')
+    args = parser.parse_args()
+
+    if args.cmd == 'gen':
+        if not os.path.exists(args.out):
+            os.makedirs(args.out)
+        gen_synthetic(os.path.join(args.out, 'train.json'), args.train, True, args.seed)
+        gen_synthetic(os.path.join(args.out, 'test.json'), args.test, False, args.seed + 1)
+        print('wrote %d train and %d test chips to %s' % (args.train, args.test, args.out))
+    elif args.cmd == 'stage':
+        print(json.dumps(run_stage(args.name, args)))
+    elif args.cmd == 'run':
+        report = run(args)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=1)
+    elif args.cmd == 'compare':
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        slower = compare(old, new, args.threshold)
+        if slower:
+            print('slower: %s' % ', '.join(slower))
+            sys.exit(1)
+    else:
+        parser.print_help()
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os, sys, json, time, argparse, subprocess
+import numpy as np
+
+EPS = 1e-15
+
+
+def fold_indices(labels, k, seed=0):
+    """stratified fold id of every training chip"""
+    rng = np.random.RandomState(seed)
+    folds = np.empty(len(labels), dtype='int64')
+    for c in np.unique(labels):
+        idx = np.where(labels == c)[0]
+        rng.shuffle(idx)
+        folds[idx] = np.arange(len(idx)) % k
+    return folds
+
+
+def logloss(y, p):
+    p = np.clip(p, EPS, 1 - EPS)
+    return float(-np.mean(y * np.log(p) + (1 - y) * np.log(1 - p)))
+
+
+def run_fold(args, fold, on_epoch=None, predict=True):
+    """train one fold on the memory-mapped cache; without `predict` it writes
+    no checkpoints or predictions and never loads the test set"""
+    import mxnet as mx
+    from mxnet import nd, init
+    import utils
+
+    np.random.seed(args.seed + fold)
+    mx.random.seed(args.seed + fold)
+    src = utils.load_src_data(args.train)
+    labels = np.asarray(src['is_iceberg'])
+    folds = fold_indices(labels, args.folds, args.seed)
+    train_idx, valid_idx = np.where(folds != fold)[0], np.where(folds == fold)[0]
+    # the loaders copy each batch out of the memory-mapped cache as they draw
+    # it, so concurrent folds share its pages instead of each holding a copy
+    band, y = src['band'], labels.astype('float32')
+    augs = utils.online_augs('NHWC')
+    loader = lambda ds, **kw: utils.DataLoader(ds, args.batch_size, **kw)
+    train_kw = dict(augs=augs, rows=train_idx)
+    valid_kw = dict(augs=[utils.batch_img_norm], rows=valid_idx, shuffle=False, last_batch='keep')
+    checkpointer = None
+    if predict:
+        checkpointer = utils.Checkpointer(os.path.join(args.out, 'fold_%d' % fold),
+                                          keep_last=1, keep_best=0)
+    # test predictions are made once, below, for the final model
+    scheduler = utils.PredictionScheduler(None, on_best=False, final=False)
+
+    if args.model == 'vgg':
+        import train
+        net = train.Net_vgg10(args.conv_dropout, args.dropout)
+        net.initialize(init=init.Xavier(), ctx=mx.cpu())
+        net.hybridize()
+        train.train(net, loader((band, y), **train_kw), loader((band, y), **valid_kw), None,
+                    args.batch_size, args.epochs, args.lr, mx.cpu(),
+                    checkpointer=checkpointer, scheduler=scheduler, on_epoch=on_epoch,
+                    snapshot=False)
+        predict_to = lambda ds, filename, rows=None: utils.predict(
+            utils.TestDataLoader(ds, args.batch_size, augs=[utils.batch_img_norm], rows=rows),
+            net, filename, mx.cpu(), binary=True)
+        columns = lambda src: (src['band'], np.asarray(src['id']))
+    else:
+        import resnet
+        resnet.build(args.conv_dropout, args.dropout, args.lr)
+        resnet.net.hybridize()
+        angle = lambda a: resnet.angle_norm(nd.array(np.nan_to_num(a, nan=0.), dtype='float32'))
+        a = angle(src['inc_angle']).asnumpy()
+        resnet.train(loader((band, y, a), **train_kw), loader((band, y, a), **valid_kw), None,
+                     args.batch_size, checkpointer=checkpointer, scheduler=scheduler,
+                     epoches=args.epochs, alpha=args.alpha, beta=args.beta, on_epoch=on_epoch)
+        predict_to = lambda ds, filename, rows=None: resnet.predict(
+            utils.TestDataLoader(ds, args.batch_size, augs=[utils.batch_img_norm], rows=rows),
+            resnet.net, filename, resnet.ctx, binary=True)
+        columns = lambda src: (src['band'], np.asarray(src['id']), angle(src['inc_angle']))
+    if not predict:
+        return
+    checkpointer.close()
+
+    predict_to(columns(src), os.path.join(args.out, 'fold_%d.oof' % fold), valid_idx)
+    # the test chips are only read once the fold is trained
+    predict_to(columns(utils.load_src_data(args.test)), os.path.join(args.out, 'fold_%d.test' % fold))
+
+
+def run_folds(args):
+    """run the folds as concurrent processes, `jobs` at a time, each pinned
+    to its own block of cores"""
+    import utils
+    cores = utils.cpu_list()
+    jobs = args.jobs or min(args.folds, len(cores))
+    threads = args.threads or max(len(cores) // jobs, 1)
+    slots = [cores[i * threads: (i + 1) * threads] for i in range(jobs)]
+    pending = list(range(args.folds))
+    running = {}
+    failed = []
+    while pending or running:
+        for slot in range(jobs):
+            if slot not in running and pending:
+                fold = pending.pop(0)
+                log = open(os.path.join(args.out, 'fold_%d.log' % fold), 'w')
+                cmd = [sys.executable, os.path.abspath(__file__), '--fold', str(fold)] + sys.argv[1:]
+                proc = utils.popen_pinned(cmd, slots[slot], threads, stdout=log,
+                                          stderr=subprocess.STDOUT)
+                running[slot] = (fold, proc, log, time.time())
+                print('fold %d started on cores %s' % (fold, slots[slot]))
+        time.sleep(1)
+        for slot, (fold, proc, log, start) in list(running.items()):
+            if proc.poll() is not None:
+                log.close()
+                del running[slot]
+                print('fold %d finished with exit %d in %.0fs' % (fold, proc.returncode,
+                                                                  time.time() - start))
+                if proc.returncode:
+                    failed.append(fold)
+        sys.stdout.flush()
+    return failed
+
+
+def collect(args):
+    """score the out-of-fold predictions and average the fold test predictions"""
+    import utils
+    from merge import read_predictions, merge
+    src = utils.load_src_data(args.train)
+    label_of = dict(zip(np.asarray(src['id']), np.asarray(src['is_iceberg'])))
+    ids, probs, scores = [], [], []
+    for fold in range(args.folds):
+        fold_ids, fold_probs = read_predictions(os.path.join(args.out, 'fold_%d.oof.npz' % fold))
+        y = np.array([label_of[i] for i in fold_ids], dtype='float64')
+        scores.append(logloss(y, fold_probs))
+        print('fold %d: logloss %f on %d chips' % (fold, scores[-1], len(fold_ids)))
+        ids.append(fold_ids)
+        probs.append(fold_probs)
+    ids, probs = np.concatenate(ids), np.concatenate(probs)
+    y = np.array([label_of[i] for i in ids], dtype='float64')
+    total = logloss(y, probs)
+    print('oof logloss %f, fold mean %f +- %f' % (total, np.mean(scores), np.std(scores)))
+    with utils.PredictionWriter(os.path.join(args.out, 'oof.csv')) as writer:
+        writer.write(ids, probs)
+
+    test_ids, test_probs = merge([os.path.join(args.out, 'fold_%d.test.npz' % fold)
+                                  for fold in range(args.folds)], args.method)
+    with utils.PredictionWriter(os.path.join(args.out, 'test.csv')) as writer:
+        writer.write(test_ids, test_probs)
+    with open(os.path.join(args.out, 'scores.json'), 'w') as f:
+        json.dump({'oof_logloss': total, 'fold_logloss': scores}, f, indent=1)
+    print('wrote %s' % ', '.join(os.path.join(args.out, name)
+                                 for name in ('oof.csv', 'test.csv', 'scores.json')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='k-fold cross-validation with parallel folds')
+    parser.add_argument('--model', choices=['vgg', 'resnet'], default='vgg')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--jobs', type=int, help='folds trained at once (default: min(folds, cores))')
+    parser.add_argument('--threads', type=int, help='OpenMP threads per fold (default: cores // jobs)')
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--lr', type=float, default=.001)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--conv-dropout', type=float, default=.2)
+    parser.add_argument('--dropout', type=float, default=.5)
+    parser.add_argument('--alpha', type=float, nargs=2, default=[0.75, 1.0], help='resnet focal loss alpha')
+    parser.add_argument('--beta', type=float, default=2.0, help='resnet focal loss beta')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--method', default='mean', help='merge.py method for the test average')
+    parser.add_argument('--train', default='input/train.json')
+    parser.add_argument('--test', default='input/test.json')
+    parser.add_argument('-o', '--out', default='./cv_out')
+    parser.add_argument('--fold', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.fold is not None:
+        run_fold(args, args.fold)
+        sys.exit(0)
+
+    import utils
+    if not os.path.exists(args.out):
+        os.makedirs(args.out)
+    utils.prepare_caches(args.train, args.test)
+    failed = run_folds(args)
+    if failed:
+        print('folds %s failed, see %s/fold_*.log' % (failed, args.out))
+        sys.exit(1)
+    collect(args)
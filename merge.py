@@ -1,18 +1,94 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
 
-ids = [7, 9, 10, 13]
+import argparse
+import glob
+import numpy as np
 
+EPS = 1e-15
 
-result = {}
-for id in ids:
-	with open('./predict_result/result.epoch_%d' % id) as f:
+
+def read_predictions(path):
+	"""return the id and is_iceberg columns of a prediction file (csv or .npz)"""
+	if path.endswith('.npz'):
+		z = np.load(path)
+		return z['id'], z['is_iceberg'].astype('float64')
+	ids, probs = [], []
+	with open(path) as f:
 		for line in f:
 			arr = line.strip().split(',')
-			if arr[0] not in result:
-				result[arr[0]] = []
-			result[arr[0]].append(float(arr[1]))
+			if len(arr) < 2 or arr[0] == 'id':
+				continue
+			ids.append(arr[0])
+			probs.append(float(arr[1]))
+	return np.array(ids), np.array(probs, dtype='float64')
+
+
+def _rank(p):
+	# tied probabilities share their mean rank, so no file order breaks the tie
+	_, group, counts = np.unique(p, return_inverse=True, return_counts=True)
+	r = (np.cumsum(counts) - (counts + 1) / 2.)[group]
+	return r / max(len(p) - 1, 1)
+
+
+def _logit(p):
+	p = np.clip(p, EPS, 1 - EPS)
+	return np.log(p) - np.log1p(-p)
+
+
+# per-file transform accumulated as a weighted sum, and the inverse applied to the average
+METHODS = {
+	'mean': (lambda p: p, lambda s: s),
+	'geometric': (lambda p: np.log(np.clip(p, EPS, 1.)), np.exp),
+	'logit': (_logit, lambda s: 1. / (1. + np.exp(-s))),
+	'rank': (_rank, lambda s: s),
+}
+
+
+def merge(paths, method='mean', weights=None):
+	"""average prediction files aligned on id, one file in memory at a time"""
+	forward, inverse = METHODS[method]
+	if weights is None:
+		weights = [1.] * len(paths)
+	ids, acc, index = None, None, None
+	for path, w in zip(paths, weights):
+		cur_ids, probs = read_predictions(path)
+		if ids is None:
+			ids, acc = cur_ids, np.zeros(len(cur_ids), dtype='float64')
+		elif not np.array_equal(cur_ids, ids):
+			if index is None:
+				index = dict((k, i) for i, k in enumerate(ids))
+			if len(cur_ids) != len(ids):
+				raise ValueError('%s has %d rows, expected %d' % (path, len(cur_ids), len(ids)))
+			pos = np.array([index[k] for k in cur_ids])
+			aligned = np.empty_like(probs)
+			aligned[pos] = probs
+			probs = aligned
+		acc += w * forward(probs)
+	return ids, inverse(acc / sum(weights))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='ensemble prediction files')
+	parser.add_argument('inputs', nargs='*', default=['./predict_result/result.epoch_*'],
+						help='prediction files or glob patterns (csv or .npz)')
+	parser.add_argument('--method', choices=sorted(METHODS), default='mean')
+	parser.add_argument('--weights', type=float, nargs='+',
+						help='one weight per matched file, in sorted order')
+	parser.add_argument('-o', '--output', default='result.epoch_merge')
+	args = parser.parse_args()
 
-outf = open('result.epoch_merge', 'w')
-outf.write('id,is_iceberg\n')
+	paths = []
+	for pattern in args.inputs:
+		paths.extend(sorted(glob.glob(pattern)) or [pattern])
+	# a csv written alongside its binary copy counts once, read from the .npz
+	found = set(paths)
+	paths = [p for p in paths if p + '.npz' not in found]
+	if args.weights is not None and len(args.weights) != len(paths):
+		parser.error('got %d weights for %d files' % (len(args.weights), len(paths)))
 
-for id in result:
-	outf.write('%s,%f\n' % (id, sum(result[id]) / len(ids)))
\ No newline at end of file
+	ids, probs = merge(paths, args.method, args.weights)
+	with open(args.output, 'w') as outf:
+		outf.write('id,is_iceberg\n')
+		outf.write(''.join(['%s,%f\n' % row for row in zip(ids, probs)]))
+	print('merged %d files (%s) into %s' % (len(paths), args.method, args.output))
@@ -0,0 +1,132 @@
+import os, sys, time, argparse
+import numpy as np
+import mxnet as mx
+
+from mxnet import nd
+from mxnet.contrib import quantization
+import utils
+from train import Net_vgg10, read_src_data
+
+
+def load_fp32(path, ctx):
+    """Net_vgg10 from a save_params file (model_out/vggnet_epoch_*) or a
+    Checkpointer directory (checkpoint dir with 'latest'/'best', or epoch_NNNN)"""
+    net = Net_vgg10()
+    if os.path.isdir(path):
+        net.initialize(ctx=ctx)
+        utils.resolve_shapes(net, nd.zeros((1, 2, 75, 75), ctx=ctx))
+        which = 'latest'
+        if os.path.exists(os.path.join(path, 'params')):
+            path, which = os.path.dirname(path.rstrip('/')), path
+        utils.Checkpointer(path).load(which, {'net': net})
+    else:
+        net.load_params(path, ctx=ctx)
+    net.hybridize(static_alloc=True, static_shape=True)
+    return net
+
+
+def find_valid_idx(path):
+    """the valid_idx.npy train.py wrote next to the model at `path` (a params
+    file, a checkpoint directory or one of its epoch_NNNN entries), or None"""
+    directory = path.rstrip('/') if os.path.isdir(path) else os.path.dirname(path)
+    if os.path.exists(os.path.join(directory, 'params')):
+        directory = os.path.dirname(directory)
+    found = os.path.join(directory, 'valid_idx.npy')
+    return found if os.path.exists(found) else None
+
+
+def quantize(net, calib_x, batch_size, calib_mode='naive', ctx=mx.cpu()):
+    """post-training INT8 quantization of a hybridized net, with layer output
+    thresholds calibrated on `calib_x` (NCHW, normalized)"""
+    calib_data = mx.io.NDArrayIter(calib_x, batch_size=batch_size)
+    qnet = quantization.quantize_net_v2(
+        net, quantized_dtype='auto', calib_data=calib_data, calib_mode=calib_mode,
+        num_calib_examples=calib_x.shape[0], ctx=ctx)
+    # the fused graph only exposes its parameters to export() once it has run
+    qnet.hybridize(static_alloc=True, static_shape=True)
+    qnet(calib_x[:batch_size]).wait_to_read()
+    return qnet
+
+
+def latency(net, x, repeat=20):
+    """median seconds per forward pass over batch `x`"""
+    net(x).wait_to_read()
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        net(x).wait_to_read()
+        times.append(time.time() - start)
+    return float(np.median(times))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='quantize a trained Net_vgg10 to INT8')
+    parser.add_argument('checkpoint',
+                        help='model_out/vggnet_epoch_* params file or a checkpoint directory')
+    parser.add_argument('-o', '--output', default='./model_out/vggnet_int8',
+                        help='prefix of the exported -symbol.json/-0000.params pair')
+    parser.add_argument('--calib-size', type=int, default=512,
+                        help='validation chips used for calibration (at most half of them)')
+    parser.add_argument('--eval-size', type=int, default=1024,
+                        help='other validation chips used to compare fp32 and int8')
+    parser.add_argument('--calib-mode', choices=['naive', 'entropy'], default='naive')
+    parser.add_argument('--batch-size', type=int, default=128)
+    split = parser.add_mutually_exclusive_group()
+    split.add_argument('--valid-idx', metavar='FILE',
+                       help='row indices of input/train.json the model never trained on (.npy or '
+                            'one per line; default: the valid_idx.npy train.py wrote next to the model)')
+    split.add_argument('--seed', type=int,
+                       help="rebuild the validation split of a train.py run with this --seed instead")
+    parser.add_argument('--predict', metavar='FILE',
+                        help='also score input/test.json with the INT8 model into FILE')
+    args = parser.parse_args()
+    if args.valid_idx is None and args.seed is None:
+        args.valid_idx = find_valid_idx(args.checkpoint)
+        if args.valid_idx is None:
+            parser.error('no valid_idx.npy next to %s, pass --valid-idx or --seed' % args.checkpoint)
+
+    ctx = mx.cpu()
+    ds, labels = read_src_data()
+    # calibrate and evaluate only on chips the model never trained on
+    if args.valid_idx:
+        if args.valid_idx.endswith('.npy'):
+            valid_idx = np.load(args.valid_idx)
+        else:
+            valid_idx = np.loadtxt(args.valid_idx, dtype='int64', ndmin=1)
+    else:
+        np.random.seed(args.seed)
+        _, valid_idx = utils.split_indices(ds.shape[0])
+    calib_size = min(args.calib_size, len(valid_idx) // 2)
+    calib_idx = valid_idx[:calib_size]
+    eval_idx = valid_idx[calib_size:calib_size + args.eval_size]
+    x = utils.to_nchw(utils.batch_img_norm(ds.astype('float32')))
+    labels = nd.array(np.asarray(labels)).astype('float32')
+    calib_x = nd.take(x, nd.array(calib_idx))
+    valid_ds = (nd.take(x, nd.array(eval_idx)), nd.take(labels, nd.array(eval_idx)))
+    valid_data = utils.DataLoader(valid_ds, args.batch_size, shuffle=False, layout='NCHW',
+                                  last_batch='keep')
+    print('calibration %d, evaluation %d chips' % (calib_x.shape[0], valid_ds[0].shape[0]))
+    sys.stdout.flush()
+
+    net = load_fp32(args.checkpoint, ctx)
+    qnet = quantize(net, calib_x, args.batch_size, args.calib_mode, ctx)
+    qnet.export(args.output)
+    print('wrote %s-symbol.json, %s-0000.params' % (args.output, args.output))
+    qnet = utils.load_exported(args.output, ctx)
+
+    fp32_acc, fp32_loss = utils.evaluate_accuracy(valid_data, net, ctx)
+    int8_acc, int8_loss = utils.evaluate_accuracy(valid_data, qnet, ctx)
+    batch = valid_ds[0][:args.batch_size]
+    fp32_t = latency(net, batch)
+    int8_t = latency(qnet, batch)
+    print('fp32: acc %f, logloss %f, %.2f ms/batch' % (fp32_acc, fp32_loss, fp32_t * 1000))
+    print('int8: acc %f, logloss %f, %.2f ms/batch' % (int8_acc, int8_loss, int8_t * 1000))
+    print('delta: acc %+f, logloss %+f, speedup %.2fx'
+          % (int8_acc - fp32_acc, int8_loss - fp32_loss, fp32_t / int8_t))
+
+    if args.predict:
+        test, ids = read_src_data(False)
+        test_ds = (utils.to_nchw(utils.batch_img_norm(test, out=test)), ids)
+        test_data = utils.TestDataLoader(test_ds, args.batch_size, layout='NCHW')
+        utils.predict(test_data, qnet, args.predict, ctx)
+        print('wrote %s' % args.predict)
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os, time, argparse, threading, queue
+import numpy as np
+import mxnet as mx
+
+from mxnet import nd
+import utils
+from serve import load_model
+
+
+def read_chunks(path, chunk_size, source='auto'):
+    """yield (ids, bands, angles) chunks in file order, from the memory-mapped
+    cache or by decoding the json; missing angles are NaN"""
+    cache_dir = utils.fresh_cache(path) if source != 'json' else None
+    if source == 'cache' and cache_dir is None:
+        cache_dir = utils.build_src_cache(path)
+    if cache_dir is not None:
+        src = utils.load_src_data(path, cache_dir)
+        for i in range(0, src['band'].shape[0], chunk_size):
+            yield (np.array(src['id'][i:i + chunk_size]),
+                   np.array(src['band'][i:i + chunk_size]),
+                   np.array(src['inc_angle'][i:i + chunk_size]))
+        return
+
+    ids, bands, angles, n = [], None, None, 0
+    for rec in utils.iter_src_records(path):
+        if bands is None:
+            bands = np.empty((chunk_size,) + utils.IMG_SHAPE, dtype='float32')
+            angles = np.empty((chunk_size,), dtype='float32')
+        angles[n] = utils.decode_record(rec, bands[n])
+        ids.append(rec['id'])
+        n += 1
+        if n == chunk_size:
+            yield np.array(ids, dtype='U'), bands, angles
+            ids, bands, angles, n = [], None, None, 0
+    if n:
+        yield np.array(ids, dtype='U'), bands[:n], angles[:n]
+
+
+def _pump(produce, out):
+    """run `produce` (which calls out.put) in a thread, ending the stream with
+    None, or with the exception that stopped it"""
+    def run():
+        try:
+            produce()
+            out.put(None)
+        except BaseException as e:
+            out.put(e)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _drain(q):
+    while True:
+        item = q.get()
+        if isinstance(item, BaseException):
+            raise item
+        if item is None:
+            return
+        yield item
+
+
+def score(forward, path, filename, chunk_size=256, source='auto', depth=2, tta=None,
+          ctx=mx.cpu(), binary=False):
+    """score a test json into `filename`, overlapping decoding, inference and
+    writing through queues of `depth` chunks; returns (chips, seconds)"""
+    chunks, results = queue.Queue(depth), queue.Queue(depth)
+    k = len(tta) if tta else 1
+
+    def read():
+        for chunk in read_chunks(path, chunk_size, source):
+            chunks.put(chunk)
+    reader = _pump(read, chunks)
+
+    def write():
+        try:
+            with utils.PredictionWriter(filename, binary, keep=False) as writer:
+                for ids, prob in _drain(results):
+                    writer.write(ids, prob)
+        except BaseException:
+            for _ in _drain(results):
+                pass  # keep the compute stage from blocking on a full queue
+            raise
+    writer_done = queue.Queue()
+    writer = _pump(write, writer_done)
+
+    start, n = time.time(), 0
+    try:
+        for ids, bands, angles in _drain(chunks):
+            x = utils.to_nchw(utils.batch_img_norm(nd.array(bands, ctx=ctx)))
+            angle = nd.array(np.nan_to_num(angles, nan=0.), ctx=ctx)
+            if tta:
+                x = utils.tta_views(x, tta)
+                angle = nd.tile(angle, reps=(k,))
+            prob = utils.tta_mean(forward(x, angle), k)
+            # blocks until the chunk is computed, while the next one is decoded
+            results.put((ids, prob.asnumpy()))
+            n += len(ids)
+    finally:
+        results.put(None)
+        writer.join()
+    err = writer_done.get()
+    if err is not None:
+        raise err
+    reader.join()
+    return n, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='stream a test json through a trained model')
+    parser.add_argument('checkpoint', help='params file, checkpoint directory or exported model prefix')
+    parser.add_argument('--model', choices=['vgg', 'resnet'], default='vgg')
+    parser.add_argument('-i', '--input', default='input/test.json')
+    parser.add_argument('-o', '--output', default='./predict_result/result.score')
+    parser.add_argument('--source', choices=['auto', 'json', 'cache'], default='auto',
+                        help='read the binary cache (auto: when it is up to date) or stream the json')
+    parser.add_argument('--chunk-size', type=int, default=256, help='chips decoded and scored at once')
+    parser.add_argument('--depth', type=int, default=2, help='chunks buffered between stages')
+    parser.add_argument('--tta', nargs='+', choices=utils.TTA_VIEWS,
+                        help='average test predictions over these views, e.g. orig hflip vflip')
+    parser.add_argument('--binary', action='store_true',
+                        help='also write <output>.npz (keeps the columns in memory)')
+    args = parser.parse_args()
+
+    out_dir = os.path.dirname(args.output)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    ctx = mx.cpu()
+    forward = load_model(args.model, args.checkpoint, ctx)
+    n, seconds = score(forward, args.input, args.output, args.chunk_size, args.source,
+                       args.depth, args.tta, ctx, args.binary)
+    print('scored %d chips in %.1fs (%.1f chips/s) into %s' % (n, seconds, n / seconds, args.output))
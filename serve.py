@@ -0,0 +1,285 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os, sys, json, time, asyncio, argparse, collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import mxnet as mx
+
+from mxnet import nd
+import utils
+
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+def load_model(model, path, ctx):
+    """forward(x, angle) -> iceberg probabilities; `path` is a params file, a
+    checkpoint (directory) or, for vgg, an exported model prefix"""
+    if model == 'vgg':
+        if os.path.exists(path + '-symbol.json'):
+            net = utils.load_exported(path, ctx)
+        else:
+            from quantize import load_fp32
+            net = load_fp32(path, ctx)
+        return lambda x, angle: utils.softmax(net(x))[:, 1]
+
+    import resnet
+    blocks = {'net': resnet.net, 'head': resnet.head}
+    utils.resolve_shapes(resnet.net, nd.zeros((1, 2, 75, 75), ctx=ctx))
+    if os.path.exists(os.path.join(path, 'params')):
+        checkpointer = utils.Checkpointer(os.path.dirname(path.rstrip('/')))
+        checkpointer.load(path, blocks)
+    else:
+        checkpointer = utils.Checkpointer(path)
+        checkpointer.load('latest', blocks)
+    checkpointer.close()
+    resnet.net.hybridize(static_alloc=True)
+    return lambda x, angle: resnet.softmax(
+        resnet.add_angle(resnet.net(x), resnet.angle_norm(angle)))[:, 1]
+
+
+def decode_chip(rec):
+    """(75, 75, 2) band array and raw incidence angle (NaN if missing) of one
+    train/test json record"""
+    band = np.empty(utils.IMG_SHAPE, dtype='float32')
+    return band, utils.decode_record(rec, band)
+
+
+class Stats(object):
+    """request latency percentiles and throughput over the last `window` requests"""
+    def __init__(self, window=10000):
+        self.start = time.time()
+        self.latency = collections.deque(maxlen=window)
+        self.done = collections.deque(maxlen=window)
+        self.requests = self.chips = self.batches = self.batch_chips = self.padded = 0
+        self.errors = 0
+
+    def request(self, chips, seconds):
+        self.requests += 1
+        self.chips += chips
+        self.latency.append(seconds)
+        self.done.append((time.time(), chips))
+
+    def batch(self, chips, padded):
+        self.batches += 1
+        self.batch_chips += chips
+        self.padded += padded
+
+    def report(self, queued=0):
+        now = time.time()
+        lat = np.array(self.latency) * 1000. if self.latency else np.zeros(1)
+        # throughput over the window, or since start while the window is filling
+        since = self.done[0][0] if len(self.done) == self.done.maxlen else self.start
+        return {
+            'uptime_s': now - self.start, 'requests': self.requests, 'chips': self.chips,
+            'errors': self.errors, 'batches': self.batches, 'queued_chips': queued,
+            'mean_batch': self.batch_chips / max(self.batches, 1),
+            'padding': self.padded / max(self.batch_chips + self.padded, 1),
+            'latency_ms': {'p50': float(np.percentile(lat, 50)), 'p90': float(np.percentile(lat, 90)),
+                           'p99': float(np.percentile(lat, 99)), 'max': float(lat.max())},
+            'chips_per_sec': sum(n for _, n in self.done) / max(now - since, 1e-9),
+            'requests_per_sec': len(self.done) / max(now - since, 1e-9),
+        }
+
+
+class MicroBatcher(object):
+    """coalesce concurrent requests into forwards of at most max_batch chips,
+    padded to a power of two, waiting at most max_wait seconds"""
+    def __init__(self, forward, ctx, max_batch=64, max_wait=0.005, stats=None):
+        self.forward = forward
+        self.ctx = ctx
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = stats or Stats()
+        self.pending = collections.deque()
+        self.queued = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._wakeup = asyncio.Event()
+
+    def buckets(self):
+        sizes, n = [], 1
+        while n < self.max_batch:
+            sizes.append(n)
+            n *= 2
+        return sizes + [self.max_batch]
+
+    def _bucket(self, n):
+        # a single request larger than max_batch runs at its own size
+        return min([b for b in self.buckets() if b >= n] or [n])
+
+    def _infer(self, bands, angles):
+        n = bands.shape[0]
+        size = self._bucket(n)
+        if size > n:
+            bands = np.concatenate([bands, np.repeat(bands[-1:], size - n, axis=0)])
+            angles = np.concatenate([angles, np.repeat(angles[-1:], size - n)])
+        x = utils.to_nchw(utils.batch_img_norm(nd.array(bands, ctx=self.ctx)))
+        return self.forward(x, nd.array(angles, ctx=self.ctx)).asnumpy()[:n], size - n
+
+    def warmup(self):
+        """run every bucket shape once, so no request pays for graph building"""
+        for size in self.buckets():
+            self._infer(np.random.rand(size, *utils.IMG_SHAPE).astype('float32'),
+                        np.zeros(size, dtype='float32'))
+
+    async def submit(self, bands, angles):
+        """iceberg probabilities of (n, 75, 75, 2) chips, scored with whatever
+        else is queued at the time"""
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((bands, angles, fut, time.time()))
+        self.queued += bands.shape[0]
+        self._wakeup.set()
+        return await fut
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            deadline = self.pending[0][3] + self.max_wait
+            while self.queued < self.max_batch and time.time() < deadline:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), deadline - time.time())
+                except asyncio.TimeoutError:
+                    break
+            batch, n = [], 0
+            while self.pending and (not batch or n + self.pending[0][0].shape[0] <= self.max_batch):
+                item = self.pending.popleft()
+                batch.append(item)
+                n += item[0].shape[0]
+            self.queued -= n
+            bands = np.concatenate([b for b, _, _, _ in batch])
+            angles = np.concatenate([a for _, a, _, _ in batch])
+            try:
+                probs, padded = await loop.run_in_executor(self.executor, self._infer, bands, angles)
+            except Exception as e:
+                for _, _, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            self.stats.batch(n, padded)
+            pos = 0
+            for b, _, fut, _ in batch:
+                if not fut.done():
+                    fut.set_result(probs[pos:pos + b.shape[0]])
+                pos += b.shape[0]
+
+
+class Server(object):
+    """minimal HTTP/1.1 (keep-alive) front end of a MicroBatcher:
+    POST /predict takes one train/test json record or a list of them,
+    GET /stats returns the latency and throughput counters"""
+    def __init__(self, batcher, max_body=64 << 20):
+        self.batcher = batcher
+        self.stats = batcher.stats
+        self.max_body = max_body
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target = line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b'\r\n', b'\n', b''):
+                        break
+                    k, _, v = h.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                length = int(headers.get('content-length', 0))
+                if length > self.max_body:
+                    await self._send(writer, 413, {'error': 'body over %d bytes' % self.max_body}, False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                status, payload = await self.route(method, target.split('?')[0], body)
+                await self._send(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if path == '/stats':
+            return 200, self.stats.report(self.batcher.queued)
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        if path != '/predict':
+            return 404, {'error': 'unknown path %s' % path}
+        if method != 'POST':
+            return 405, {'error': 'POST a record or a list of records'}
+        start = time.time()
+        try:
+            recs = json.loads(body.decode('utf-8'))
+            single = isinstance(recs, dict)
+            recs = [recs] if single else recs
+            chips = [decode_chip(rec) for rec in recs]
+        except (ValueError, KeyError, TypeError) as e:
+            self.stats.errors += 1
+            return 400, {'error': 'bad record: %s' % e}
+        if not chips:
+            return 200, []
+        bands = np.stack([b for b, _ in chips])
+        angles = np.nan_to_num(np.array([a for _, a in chips], dtype='float32'), nan=0.)
+        try:
+            probs = await self.batcher.submit(bands, angles)
+        except Exception as e:
+            self.stats.errors += 1
+            return 500, {'error': str(e)}
+        self.stats.request(len(chips), time.time() - start)
+        out = [{'id': rec.get('id'), 'is_iceberg': float(p)} for rec, p in zip(recs, probs)]
+        return 200, out[0] if single else out
+
+    async def _send(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode('utf-8')
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                      'Content-Length: %d\r\nConnection: %s\r\n\r\n'
+                      % (status, HTTP_STATUS[status], len(body),
+                         'keep-alive' if keep_alive else 'close')).encode('latin-1') + body)
+        await writer.drain()
+
+
+async def serve(args, batcher):
+    server = Server(batcher)
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix)
+        where = 'unix:%s' % args.unix
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        where = 'http://%s:%d' % (args.host, args.port)
+    print('serving %s on %s (max batch %d, max wait %.1f ms)'
+          % (args.model, where, batcher.max_batch, batcher.max_wait * 1000))
+    sys.stdout.flush()
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), batcher.run())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='score single SAR chips over HTTP with dynamic batching')
+    parser.add_argument('checkpoint', help='params file, checkpoint directory or exported model prefix')
+    parser.add_argument('--model', choices=['vgg', 'resnet'], default='vgg')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', metavar='PATH', help='listen on a unix socket instead')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=5.,
+                        help='longest a request waits for others to join its batch')
+    args = parser.parse_args()
+
+    ctx = mx.cpu()
+    batcher = MicroBatcher(load_model(args.model, args.checkpoint, ctx), ctx,
+                           args.max_batch, args.max_wait_ms / 1000.)
+    batcher.executor.submit(batcher.warmup).result()
+    try:
+        asyncio.run(serve(args, batcher))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os, sys, json, time, argparse, subprocess, threading
+import numpy as np
+
+import utils
+
+# name: (kind, low, high) or ('choice', values); the focal loss terms only
+# exist in the resnet
+SPACE = {
+    'lr': ('log', 1e-4, 3e-3),
+    'conv_dropout': ('uniform', 0., .4),
+    'dropout': ('uniform', .2, .6),
+    'batch_size': ('choice', [32, 64, 128, 256]),
+    'alpha0': ('uniform', .25, 1.),
+    'beta': ('uniform', 0., 3.),
+}
+RESNET_ONLY = ('alpha0', 'beta')
+
+
+def sample(rng, model):
+    """one random configuration from SPACE"""
+    config = {}
+    for name, spec in sorted(SPACE.items()):
+        if model != 'resnet' and name in RESNET_ONLY:
+            continue
+        if spec[0] == 'choice':
+            config[name] = spec[1][rng.randint(len(spec[1]))]
+        elif spec[0] == 'log':
+            config[name] = float(np.exp(rng.uniform(np.log(spec[1]), np.log(spec[2]))))
+        else:
+            config[name] = float(rng.uniform(spec[1], spec[2]))
+    return config
+
+
+class SuccessiveHalving(object):
+    """asynchronous successive halving: a trial passes a rung only if its
+    logloss is in the best 1/eta recorded there so far"""
+
+    def __init__(self, min_epochs, max_epochs, eta=3):
+        self.eta = eta
+        self.rungs = []
+        epochs = min_epochs
+        while epochs < max_epochs:
+            self.rungs.append(epochs)
+            epochs *= eta
+        self.results = dict((r, []) for r in self.rungs)
+
+    def report(self, epoch, loss):
+        """record the loss after `epoch` (0-based); False prunes the trial"""
+        rung = epoch + 1
+        if rung not in self.results:
+            return True
+        recorded = self.results[rung]
+        recorded.append(loss)
+        if len(recorded) < self.eta:
+            return True
+        return loss <= np.percentile(recorded, 100. / self.eta)
+
+
+class Trial(object):
+    """one configuration running as a pinned child process. The child prints
+    a SWEEP line after each validation and blocks until it is told to
+    continue or stop"""
+
+    def __init__(self, index, config, cmd, cores, threads, log_path, decide):
+        self.index = index
+        self.config = config
+        self.history = []
+        self.status = 'running'
+        self.start = time.time()
+        self.log = open(log_path, 'w')
+        self.decide = decide
+        self.proc = utils.popen_pinned(cmd, cores, threads, stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read(self):
+        for line in iter(self.proc.stdout.readline, b''):
+            line = line.decode('utf-8', 'replace')
+            if not line.startswith('SWEEP '):
+                self.log.write(line)
+                self.log.flush()
+                continue
+            report = json.loads(line[len('SWEEP '):])
+            self.history.append(report['logloss'])
+            go_on = self.decide(report['epoch'], report['logloss'])
+            if not go_on:
+                self.status = 'pruned'
+            try:
+                self.proc.stdin.write(b'continue\n' if go_on else b'stop\n')
+                self.proc.stdin.flush()
+            except (IOError, OSError):
+                pass
+
+    def done(self):
+        if self.proc.poll() is None:
+            return False
+        self.reader.join()
+        self.log.close()
+        if self.proc.returncode:
+            self.status = 'failed'
+        elif self.status == 'running':
+            self.status = 'completed'
+        return True
+
+    def result(self):
+        return {'trial': self.index, 'config': self.config, 'status': self.status,
+                'epochs': len(self.history), 'seconds': time.time() - self.start,
+                'best_logloss': min(self.history) if self.history else None,
+                'last_logloss': self.history[-1] if self.history else None,
+                'history': self.history}
+
+
+def run_trial(args, config):
+    """train the configuration on one fold in this process, reporting each
+    epoch's validation logloss to the parent"""
+    import cv
+
+    def reporter(epoch, loss):
+        print('SWEEP ' + json.dumps({'epoch': epoch, 'logloss': float(loss)}))
+        sys.stdout.flush()
+        return sys.stdin.readline().strip() != 'stop'
+
+    ns = argparse.Namespace(
+        model=args.model, folds=args.folds, seed=args.seed, train=args.train, test=args.test,
+        out=config.pop('out'), epochs=args.max_epochs, lr=config['lr'],
+        batch_size=config['batch_size'], conv_dropout=config['conv_dropout'],
+        dropout=config['dropout'], alpha=[config.get('alpha0', .75), 1.],
+        beta=config.get('beta', 2.))
+    cv.run_fold(ns, 0, on_epoch=reporter, predict=False)
+
+
+def sweep(args):
+    """run args.trials random configurations, args.jobs at a time, each pinned
+    to its own block of cores; returns the results sorted by best logloss"""
+    rng = np.random.RandomState(args.seed)
+    cores = utils.cpu_list()
+    jobs = args.jobs or len(cores)
+    threads = args.threads or max(len(cores) // jobs, 1)
+    # jobs beyond the whole blocks of cores share them round-robin
+    blocks = max(len(cores) // threads, 1)
+    slots = [cores[(i % blocks) * threads: (i % blocks + 1) * threads] for i in range(jobs)]
+    halving = SuccessiveHalving(args.min_epochs, args.max_epochs, args.eta)
+    lock = threading.Lock()
+
+    def decide(epoch, loss):
+        with lock:
+            return halving.report(epoch, loss)
+
+    print('rungs at epochs %s of %d, %d jobs x %d threads'
+          % (halving.rungs, args.max_epochs, jobs, threads))
+    results = []
+    running = {}
+    started = 0
+    out = open(os.path.join(args.out, 'results.jsonl'), 'w')
+    while started < args.trials or running:
+        for slot in range(jobs):
+            if slot not in running and started < args.trials:
+                config = sample(rng, args.model)
+                trial_out = os.path.join(args.out, 'trial_%d' % started)
+                cmd = [sys.executable, os.path.abspath(__file__), '--trial',
+                       json.dumps(dict(config, out=trial_out))] + sys.argv[1:]
+                running[slot] = Trial(started, config, cmd, slots[slot], threads,
+                                      trial_out + '.log', decide)
+                print('trial %d started on cores %s: %s' % (started, slots[slot], json.dumps(config)))
+                started += 1
+        time.sleep(1)
+        for slot, trial in list(running.items()):
+            if trial.done():
+                del running[slot]
+                res = trial.result()
+                results.append(res)
+                out.write(json.dumps(res) + '\n')
+                out.flush()
+                print('trial %d %s after %d epochs, best logloss %s'
+                      % (res['trial'], res['status'], res['epochs'], res['best_logloss']))
+        sys.stdout.flush()
+    out.close()
+    missing = float('inf')
+    return sorted(results, key=lambda r: missing if r['best_logloss'] is None else r['best_logloss'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='random hyperparameter sweep with successive halving')
+    parser.add_argument('--model', choices=['vgg', 'resnet'], default='vgg')
+    parser.add_argument('--trials', type=int, default=27)
+    parser.add_argument('--jobs', type=int, help='trials run at once (default: cores)')
+    parser.add_argument('--threads', type=int, help='OpenMP threads per trial (default: cores // jobs)')
+    parser.add_argument('--min-epochs', type=int, default=3, help='epochs before the first pruning')
+    parser.add_argument('--max-epochs', type=int, default=27)
+    parser.add_argument('--eta', type=int, default=3, help='keep the best 1/eta at every rung')
+    parser.add_argument('--folds', type=int, default=5,
+                        help='trials validate on the first of this many stratified folds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--train', default='input/train.json')
+    parser.add_argument('--test', default='input/test.json')
+    parser.add_argument('-o', '--out', default='./sweep_out')
+    parser.add_argument('--trial', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.trial is not None:
+        run_trial(args, json.loads(args.trial))
+        sys.exit(0)
+
+    if not os.path.exists(args.out):
+        os.makedirs(args.out)
+    utils.prepare_caches(args.train, args.test)
+    results = sweep(args)
+    print('%5s %9s %7s %10s  %s' % ('trial', 'status', 'epochs', 'logloss', 'config'))
+    for res in results:
+        print('%5d %9s %7d %10s  %s' % (res['trial'], res['status'], res['epochs'],
+                                        '%.6f' % res['best_logloss'] if res['best_logloss'] is not None
+                                        else '-', json.dumps(res['config'])))
+    print('wrote %s' % os.path.join(args.out, 'results.jsonl'))
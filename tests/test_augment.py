@@ -0,0 +1,21 @@
+import numpy as np
+import mxnet as mx
+from mxnet import nd
+
+import utils
+
+
+def constant_batch(n=64, value=-26.27, layout='NHWC'):
+    shape = (n, 75, 75, 2) if layout == 'NHWC' else (n, 2, 75, 75)
+    return nd.full(shape, value)
+
+
+def test_crops_replicate_the_border():
+    mx.random.seed(0)
+    for layout in ('NHWC', 'NCHW'):
+        x = constant_batch(layout=layout)
+        for aug in (utils.BatchRandomSizedCropAug((75, 75), .75, (.8, 1.2), layout),
+                    utils.BatchRandomCropAug((50, 50), (75, 75), layout),
+                    utils.BatchCenterCropAug((50, 50), (75, 75), layout)):
+            out = aug(x).asnumpy()
+            np.testing.assert_allclose(out, -26.27, rtol=0, atol=1e-4)
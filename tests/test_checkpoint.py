@@ -0,0 +1,81 @@
+import numpy as np
+import mxnet as mx
+from mxnet import gluon, nd, init
+
+import utils
+import train
+
+
+def loaders(n=64, batch_size=16, seed=0):
+    rng = np.random.RandomState(seed)
+    x = nd.array(rng.rand(n, 2, 75, 75), dtype='float32')
+    y = nd.array(rng.randint(2, size=n), dtype='float32')
+    return (utils.DataLoader((x, y), batch_size, layout='NCHW'),
+            utils.DataLoader((x, y), batch_size, shuffle=False, layout='NCHW', last_batch='keep'))
+
+
+def fresh_net():
+    net = train.Net_vgg10()
+    net.initialize(init=init.Xavier(), ctx=mx.cpu())
+    return net
+
+
+def run(net, directory, epochs, resume=None):
+    train_data, valid_data = loaders()
+    checkpointer = utils.Checkpointer(directory, keep_last=2, keep_best=1)
+    scheduler = utils.PredictionScheduler(None, on_best=False, final=False)
+    train.train(net, train_data, valid_data, None, 16, epochs, .001, mx.cpu(),
+                checkpointer=checkpointer, resume=resume, scheduler=scheduler)
+    checkpointer.close()
+    return checkpointer
+
+
+def params(net):
+    return dict((name, p.data().asnumpy()) for name, p in net._collect_params_with_prefix().items())
+
+
+def test_resume_into_a_new_net(tmp_path):
+    trained = fresh_net()
+    run(trained, str(tmp_path), 1)
+    # no epochs left to train, so the new net must hold exactly the saved state
+    resumed = fresh_net()
+    checkpointer = run(resumed, str(tmp_path), 1, resume='latest')
+    assert [e['epoch'] for e in checkpointer.index] == [0]
+    saved, loaded = params(trained), params(resumed)
+    assert sorted(saved) == sorted(loaded)
+    for name in saved:
+        np.testing.assert_array_equal(saved[name], loaded[name], err_msg=name)
+
+
+def test_resume_continues_training(tmp_path):
+    run(fresh_net(), str(tmp_path), 1)
+    checkpointer = run(fresh_net(), str(tmp_path), 2, resume='latest')
+    assert sorted(e['epoch'] for e in checkpointer.index) == [0, 1]
+
+
+def test_early_stop_restores_best_epoch_after_resume(tmp_path):
+    # with min_delta the lowest score (epoch 2) is not the best epoch (0)
+    net = gluon.nn.Dense(2, in_units=3)
+    net.initialize(ctx=mx.cpu())
+    predicted = []
+    def predict(filename):
+        predicted.append(filename)
+        return None, None
+    def helpers():
+        checkpointer = utils.Checkpointer(str(tmp_path), keep_last=1, keep_best=1)
+        scheduler = utils.PredictionScheduler(predict, on_best=False)
+        early_stop = utils.EarlyStopping(patience=5, min_delta=.1)
+        return utils.EpochHooks({'net': net}, None, checkpointer, scheduler,
+                                early_stop=early_stop)
+    hooks = helpers()
+    for epoch, score in enumerate([1., .98, .95]):
+        net.weight.set_data(nd.full((2, 3), epoch))
+        hooks.end_epoch(epoch, score)
+    hooks.checkpointer.close()
+
+    hooks = helpers()
+    assert hooks.resume('latest') == 3
+    hooks.finish(2)
+    hooks.checkpointer.close()
+    np.testing.assert_array_equal(net.weight.data().asnumpy(), np.zeros((2, 3)))
+    assert predicted == ['./predict_result/result.epoch_0']
@@ -0,0 +1,25 @@
+import os, sys, subprocess
+
+import bench
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def train_py(cwd, *args):
+    cmd = [sys.executable, os.path.join(ROOT, 'train.py'), '--online-aug', '--workers', '2',
+           '--batch-size', '32', '--seed', '0', '--checkpoint-dir', 'ck'] + list(args)
+    return subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          timeout=900)
+
+
+def test_workers_resume(tmp_path):
+    for name in ('input', 'predict_result'):
+        os.makedirs(str(tmp_path / name))
+    bench.gen_synthetic(str(tmp_path / 'input' / 'train.json'), 96)
+    bench.gen_synthetic(str(tmp_path / 'input' / 'test.json'), 16, labeled=False, seed=1)
+    first = train_py(str(tmp_path), '--epochs', '1')
+    assert first.returncode == 0, first.stdout.decode()[-2000:]
+    # the restored parameters must pass dist kvstore init on every worker
+    resumed = train_py(str(tmp_path), '--epochs', '2', '--resume', 'latest')
+    assert resumed.returncode == 0, resumed.stdout.decode()[-2000:]
+    assert os.path.isdir(str(tmp_path / 'ck' / 'epoch_0001'))
@@ -0,0 +1,8 @@
+import numpy as np
+
+import merge
+
+
+def test_rank_averages_ties():
+	np.testing.assert_allclose(merge._rank(np.array([.3, .1, .3, .9])), [1.5 / 3, 0, 1.5 / 3, 1])
+	np.testing.assert_allclose(merge._rank(np.array([.5, .5])), [.5, .5])
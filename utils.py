@@ -5,65 +5,868 @@ from mxnet import image
 from mxnet.gluon import nn
 import mxnet as mx
 import numpy as np
-from time import time
+import os, json, math, random, pickle, shutil, collections, multiprocessing
+import sys, signal, socket, subprocess, threading, queue
+from time import time, sleep
 import matplotlib.pyplot as plt
 
+IMG_SHAPE = (75, 75, 2)
+
+def _cache_dir(path):
+    return os.path.splitext(path)[0] + '.cache'
+
+def _src_stamp(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+def _count_records(path, chunk_size=1 << 22):
+    """count the chips in a train/test json without decoding it"""
+    key = b'"band_1"'
+    n, tail = 0, b''
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buf = tail + chunk
+            n += buf.count(key)
+            tail = buf[1 - len(key):]
+    return n
+
+def iter_src_records(path, chunk_size=1 << 20):
+    """yield the chips of a train/test json one at a time, so only a single
+    decoded record and one read chunk are alive at any point"""
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        buf, pos, eof = '', 0, False
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,[':
+                pos += 1
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                img, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    if buf[pos:].strip():
+                        raise
+                    return
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            pos = end
+            yield img
+
+def decode_record(rec, band_out):
+    """write the bands of one train/test json record into a (75, 75, 2) buffer
+    and return its incidence angle, NaN where it is 'na' or missing"""
+    band_out[:, :, 0] = np.asarray(rec['band_1'], dtype='float32').reshape(IMG_SHAPE[:2])
+    band_out[:, :, 1] = np.asarray(rec['band_2'], dtype='float32').reshape(IMG_SHAPE[:2])
+    angle = rec.get('inc_angle', 'na')
+    return np.nan if angle in ('na', None) else float(angle)
+
+def _decode_into(path, band):
+    """stream a train/test json into a preallocated (N, 75, 75, 2) buffer and
+    return its id / inc_angle / is_iceberg columns"""
+    n = band.shape[0]
+    angle = np.empty((n,), dtype='float32')
+    labels = np.empty((n,), dtype='int8')
+    ids = []
+    for i, img in enumerate(iter_src_records(path)):
+        angle[i] = decode_record(img, band[i])
+        labels[i] = img.get('is_iceberg', -1)
+        ids.append(img['id'])
+    src = {'band': band, 'inc_angle': angle, 'id': np.array(ids, dtype='U')}
+    if (labels >= 0).all():
+        src['is_iceberg'] = labels
+    return src
+
+def read_src_records(path):
+    """decode a train/test json straight into in-memory numpy columns"""
+    band = np.empty((_count_records(path),) + IMG_SHAPE, dtype='float32')
+    return _decode_into(path, band)
+
+def build_src_cache(path, cache_dir=None):
+    """decode a train/test json once into a directory of .npy columns"""
+    cache_dir = cache_dir or _cache_dir(path)
+    tmp_dir = cache_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    n = _count_records(path)
+    band = np.lib.format.open_memmap(os.path.join(tmp_dir, 'band.npy'), mode='w+',
+                                     dtype='float32', shape=(n,) + IMG_SHAPE)
+    src = _decode_into(path, band)
+    band.flush()
+    del src['band'], band
+    for name in src:
+        np.save(os.path.join(tmp_dir, name + '.npy'), src[name])
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(dict(_src_stamp(path), n=n), f)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+    return cache_dir
+
+def fresh_cache(path, cache_dir=None):
+    """the binary cache directory of a train/test json if it exists and is
+    up to date with the json, else None"""
+    cache_dir = cache_dir or _cache_dir(path)
+    meta_file = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if os.path.exists(path) and _src_stamp(path) != {'size': meta['size'], 'mtime': meta['mtime']}:
+        return None
+    return cache_dir
+
+def load_src_data(path, cache_dir=None, cache=True):
+    """return the columns of a train/test json as memory-mapped numpy arrays,
+    building the binary cache on first use or when the json has changed.
+    With cache=False the json is streamed into memory instead"""
+    if not cache:
+        return read_src_records(path)
+    cache_dir = cache_dir or _cache_dir(path)
+    if fresh_cache(path, cache_dir) is None:
+        build_src_cache(path, cache_dir)
+
+    src = {}
+    for name in ('band', 'inc_angle', 'id', 'is_iceberg'):
+        fname = os.path.join(cache_dir, name + '.npy')
+        if os.path.exists(fname):
+            src[name] = np.load(fname, mmap_mode='r')
+    return src
+
+def to_nd(arr):
+    """wrap a freshly decoded numpy buffer as an NDArray without copying it;
+    read-only (memory-mapped) arrays are copied"""
+    if arr.flags['WRITEABLE'] and arr.flags['C_CONTIGUOUS']:
+        return nd.from_numpy(arr, zero_copy=True)
+    return nd.array(arr, dtype=arr.dtype)
+
 class TestDataLoader(object): 
-    def __init__(self, dataset, batch_size): 
+    """iterate (data, *columns) batches in order, sliced zero-copy when stored
+    NCHW; `rows` and `augs` work as in DataLoader"""
+    def __init__(self, dataset, batch_size, layout='NHWC', augs=None, rows=None): 
         self.dataset = dataset
         self.batch_size = batch_size
+        self.layout = layout
+        self.augs = augs
+        self.rows = rows
 
     def __iter__(self): 
         dataset = self.dataset[:]
         X = dataset[0]
-        y = dataset[1]
-        n = X.shape[0]
-        last_i = 0
-        for i in range(n//self.batch_size):
-            last_i = i
-            batch_x = X[i*self.batch_size: (i+1)*self.batch_size]
-            batch_x = nd.transpose(batch_x, axes=(0, 3, 1, 2))
-            yield (batch_x, y[i*self.batch_size: (i+1)*self.batch_size])
-        batch_x = X[(last_i+1)*self.batch_size:]
-        batch_x = nd.transpose(batch_x, axes=(0, 3, 1, 2))
-        yield (batch_x, y[(last_i+1)*self.batch_size: ])
+        rest = dataset[1:]
+        n = X.shape[0] if self.rows is None else len(self.rows)
+        for i in range(0, n, self.batch_size):
+            take = slice(i, i+self.batch_size) if self.rows is None else self.rows[i: i+self.batch_size]
+            batch_x = X[take]
+            if not isinstance(batch_x, nd.NDArray):
+                batch_x = nd.array(batch_x, dtype=batch_x.dtype)
+            yield (_prepare_batch(batch_x, self.augs, None, self.layout),) + tuple(d[take] for d in rest)
 
 
     def __len__(self): 
-        return len(self.dataset[0])//self.batch_size
+        return len(self.dataset[0] if self.rows is None else self.rows)//self.batch_size
+
 
+class BatchSampler(object):
+    """yield the row indices of each batch; with num_parts > 1 only the
+    part_index-th shard, permuted from `seed`, which every worker must share"""
+    def __init__(self, n, batch_size, shuffle=True, last_batch='discard',
+                 num_parts=1, part_index=0, seed=0):
+        self.n = n
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.last_batch = last_batch
+        self.num_parts = num_parts
+        self.part_index = part_index
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        idx = np.arange(self.n)
+        if self.shuffle:
+            if self.num_parts > 1:
+                np.random.RandomState(self.seed + self.epoch).shuffle(idx)
+            else:
+                np.random.shuffle(idx)
+        self.epoch += 1
+        part = self.n // self.num_parts
+        idx = idx[self.part_index * part: (self.part_index + 1) * part]
+        for i in range(len(self)):
+            yield idx[i*self.batch_size: (i+1)*self.batch_size]
+
+    def __len__(self):
+        part = self.n // self.num_parts
+        if self.last_batch == 'keep':
+            return (part + self.batch_size - 1) // self.batch_size
+        return part // self.batch_size
+
+def _prepare_batch(batch_x, augs, resize, layout):
+    if augs:
+        for aug in augs:
+            batch_x = aug(batch_x)
+    if layout == 'NHWC':
+        batch_x = nd.transpose(batch_x, axes=(0, 3, 1, 2))
+    if resize:
+        batch_x = nd.contrib.BilinearResize2D(batch_x, height=resize, width=resize)
+    return batch_x
+
+# state inherited by forked DataLoader workers
+_worker_dataset, _worker_augs, _worker_resize, _worker_layout = None, None, None, None
+
+def _worker_init(dataset, augs, resize, layout, seed):
+    global _worker_dataset, _worker_augs, _worker_resize, _worker_layout
+    _worker_dataset, _worker_augs, _worker_resize = dataset, augs, resize
+    _worker_layout = layout
+    # forked workers start from the parent's RNG state, give each its own stream
+    seed = (seed + os.getpid()) % (2**31)
+    np.random.seed(seed)
+    mx.random.seed(seed)
+
+def _worker_batch(idx):
+    batch_x = _prepare_batch(nd.array(_worker_dataset[0][idx]), _worker_augs,
+                             _worker_resize, _worker_layout)
+    return (batch_x.asnumpy(),) + tuple(d[idx] for d in _worker_dataset[1:])
 
 class DataLoader(object): 
-    def __init__(self, dataset, batch_size, shuffle=True, resize=None): 
+    """iterate NCHW (data, *columns) batches, applying the batched `augs` as each
+    is drawn. Shuffled batches reuse buffers: one is only valid until the next"""
+    def __init__(self, dataset, batch_size, shuffle=True, resize=None, augs=None,
+                 num_workers=0, prefetch=2, layout='NHWC', last_batch='discard',
+                 num_parts=1, part_index=0, seed=0, rows=None): 
         self.dataset = dataset
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.resize = resize
+        self.augs = augs
+        self.num_workers = num_workers
+        self.prefetch = max(prefetch, 1)
+        self.layout = layout
+        self.last_batch = last_batch
+        self.rows = rows
+        self.sampler = BatchSampler(len(dataset[0]) if rows is None else len(rows), batch_size,
+                                    shuffle, last_batch, num_parts, part_index, seed)
+        self._pool = None
+        self._nd_dataset = None
+        self._bufs = None
 
     def __iter__(self): 
-        dataset = self.dataset[:]
-        X = dataset[0]
-        y = nd.array(dataset[1])
-        n = X.shape[0]
-        resize = self.resize
-        if self.shuffle: 
-            idx = np.arange(n)
-            np.random.shuffle(idx)
-            X = nd.array(X.asnumpy()[idx])
-            y = nd.array(y.asnumpy()[idx])
-        for i in range(n//self.batch_size):
-            batch_x = X[i*self.batch_size: (i+1)*self.batch_size]
-            if resize:
-                new_data = nd.zeros(shape=(batch_x.shape[0], resize, resize, batch_x.shape[3]))
-                for j in range(batch_x.shape[0]):
-                    new_data[j] = image.imresize(batch_x[j], resize, resize)
-                batch_x = new_data
-            batch_x = nd.transpose(batch_x, axes=(0, 3, 1, 2))
-            yield (batch_x, y[i*self.batch_size: (i+1)*self.batch_size])
+        sampler = self.sampler
+        if self.num_workers > 0:
+            for batch in self._iter_workers(sampler):
+                yield batch
+            return
+        if self.rows is not None:
+            for batch_idx in sampler:
+                rows = self.rows[batch_idx]
+                batch = [nd.array(d[rows], dtype=d.dtype) for d in self.dataset]
+                batch_x = _prepare_batch(batch[0], self.augs, self.resize, self.layout)
+                yield (batch_x,) + tuple(batch[1:])
+            return
+        if self._nd_dataset is None:
+            self._nd_dataset = [d if isinstance(d, nd.NDArray) else nd.array(d)
+                                for d in self.dataset]
+        dataset = self._nd_dataset
+        for batch_idx in sampler:
+            if self.shuffle:
+                # gather the batch rows into buffers reused across batches
+                take_idx = nd.array(batch_idx, ctx=dataset[0].context)
+                if self._bufs is None or self._bufs[0].shape[0] != len(batch_idx):
+                    batch = [nd.take(d, take_idx, axis=0) for d in dataset]
+                    if len(batch_idx) == self.batch_size:
+                        self._bufs = batch
+                else:
+                    for d, buf in zip(dataset, self._bufs):
+                        nd.take(d, take_idx, axis=0, out=buf)
+                    batch = self._bufs
+            else:
+                batch = [d[batch_idx[0]: batch_idx[-1]+1] for d in dataset]
+            batch_x = _prepare_batch(batch[0], self.augs, self.resize, self.layout)
+            yield (batch_x,) + tuple(batch[1:])
+
+    def _iter_workers(self, sampler):
+        if self._pool is None:
+            dataset = [d.asnumpy() if isinstance(d, nd.NDArray) else np.asarray(d)
+                       for d in self.dataset]
+            self._pool = multiprocessing.get_context('fork').Pool(
+                self.num_workers, initializer=_worker_init,
+                initargs=(dataset, self.augs, self.resize, self.layout,
+                          np.random.randint(2**31)))
+        pending = collections.deque()
+        for batch_idx in sampler:
+            if self.rows is not None:
+                batch_idx = self.rows[batch_idx]
+            pending.append(self._pool.apply_async(_worker_batch, (batch_idx,)))
+            if len(pending) > self.prefetch:
+                yield tuple(nd.array(d) for d in pending.popleft().get())
+        while pending:
+            yield tuple(nd.array(d) for d in pending.popleft().get())
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def __del__(self):
+        self.close()
 
     def __len__(self): 
-        return len(self.dataset[0])//self.batch_size
-            
+        return len(self.sampler)
+
+def batch_img_norm(x, per_channel=False, layout='NHWC', out=None):
+    """min-max normalize every sample (or every channel of every sample) of a
+    batch independently; pass out=x to normalize in place. Usable directly as
+    a DataLoader aug step"""
+    axis = (0, 3 if layout == 'NHWC' else 1) if per_channel else 0
+    min_val = nd.min(x, axis=axis, exclude=True, keepdims=True)
+    max_val = nd.max(x, axis=axis, exclude=True, keepdims=True)
+    if out is None:
+        return nd.broadcast_div(nd.broadcast_sub(x, min_val), max_val - min_val)
+    nd.broadcast_sub(x, min_val, out=out)
+    return nd.broadcast_div(out, max_val - min_val, out=out)
+
+def to_nchw(x):
+    """convert an NHWC dataset to the conv stacks' NCHW layout, once, so its
+    batches are not transposed"""
+    return nd.transpose(x, axes=(0, 3, 1, 2))
+
+def _hw(x, layout):
+    return x.shape[1:3] if layout == 'NHWC' else x.shape[2:4]
+
+def _crop_resize(x, x0, y0, w, h, size, layout='NHWC'):
+    """crop a box per sample out of a batch and resize it to `size` (w, h)
+    with a single bilinear sampling op; box coordinates are (N,) NDArrays in
+    pixels"""
+    H, W = _hw(x, layout)
+    ow, oh = size
+    # map output pixel centres onto the box the same way image.imresize does
+    ax = w * (ow - 1) / (ow * (W - 1.))
+    ay = h * (oh - 1) / (oh * (H - 1.))
+    bx = (2 * x0 - 1 + w / ow) / (W - 1.) - 1 + ax
+    by = (2 * y0 - 1 + h / oh) / (H - 1.) - 1 + ay
+    zeros = nd.zeros_like(x0)
+    theta = nd.stack(ax, zeros, bx, zeros, ay, by, axis=1)
+    grid = nd.GridGenerator(theta, transform_type='affine', target_shape=(oh, ow))
+    # BilinearSampler reads zeros outside the image; clamping replicates the
+    # border instead, as image.imresize does
+    grid = nd.clip(grid, -1, 1)
+    if layout == 'NCHW':
+        return nd.BilinearSampler(x, grid)
+    out = nd.BilinearSampler(nd.transpose(x, axes=(0, 3, 1, 2)), grid)
+    return nd.transpose(out, axes=(0, 2, 3, 1))
+
+def _uniform(low, high, n, ctx):
+    return nd.random.uniform(low, high, shape=(n,), ctx=ctx)
+
+class BatchHorizontalFlipAug(object):
+    """flip each sample of a batch left-right with probability p"""
+    def __init__(self, p, layout='NHWC'):
+        self.p = p
+        self.layout = layout
+
+    def __call__(self, x):
+        flip = _uniform(0, 1, x.shape[0], x.context) < self.p
+        return nd.where(flip, nd.flip(x, axis=2 if self.layout == 'NHWC' else 3), x)
+
+class BatchBrightnessJitterAug(object):
+    """scale each sample by its own factor drawn from [1 - brightness, 1 + brightness]"""
+    def __init__(self, brightness):
+        self.brightness = brightness
+
+    def __call__(self, x):
+        alpha = 1.0 + _uniform(-self.brightness, self.brightness, x.shape[0], x.context)
+        return x * alpha.reshape((-1, 1, 1, 1))
+
+class BatchRandomSizedCropAug(object):
+    """per-sample random area/aspect-ratio crop resized to `size`, the batched
+    counterpart of image.RandomSizedCropAug"""
+    def __init__(self, size, area, ratio, layout='NHWC'):
+        self.size = size
+        self.area = area if isinstance(area, tuple) else (area, 1.0)
+        self.ratio = ratio
+        self.layout = layout
+
+    def __call__(self, x):
+        n = x.shape[0]
+        H, W = _hw(x, self.layout)
+        ctx = x.context
+        area = _uniform(self.area[0], self.area[1], n, ctx) * (H * W)
+        ratio = nd.exp(_uniform(np.log(self.ratio[0]), np.log(self.ratio[1]), n, ctx))
+        w = nd.minimum(nd.round(nd.sqrt(area * ratio)), W)
+        h = nd.minimum(nd.round(nd.sqrt(area / ratio)), H)
+        x0 = nd.floor(_uniform(0, 1, n, ctx) * (W - w + 1))
+        y0 = nd.floor(_uniform(0, 1, n, ctx) * (H - h + 1))
+        return _crop_resize(x, x0, y0, w, h, self.size, self.layout)
+
+class BatchRandomCropAug(object):
+    """crop a `crop` (w, h) window at a per-sample random offset and resize it to `size`"""
+    def __init__(self, crop, size, layout='NHWC'):
+        self.crop = crop
+        self.size = size
+        self.layout = layout
+
+    def __call__(self, x):
+        n = x.shape[0]
+        H, W = _hw(x, self.layout)
+        ctx = x.context
+        w = nd.full((n,), self.crop[0], ctx=ctx)
+        h = nd.full((n,), self.crop[1], ctx=ctx)
+        x0 = nd.floor(_uniform(0, 1, n, ctx) * (W - self.crop[0] + 1))
+        y0 = nd.floor(_uniform(0, 1, n, ctx) * (H - self.crop[1] + 1))
+        return _crop_resize(x, x0, y0, w, h, self.size, self.layout)
+
+class BatchCenterCropAug(object):
+    """crop the central `crop` (w, h) window and resize it to `size`"""
+    def __init__(self, crop, size, layout='NHWC'):
+        self.crop = crop
+        self.size = size
+        self.layout = layout
+
+    def __call__(self, x):
+        n = x.shape[0]
+        H, W = _hw(x, self.layout)
+        ctx = x.context
+        w = nd.full((n,), self.crop[0], ctx=ctx)
+        h = nd.full((n,), self.crop[1], ctx=ctx)
+        x0 = nd.full((n,), (W - self.crop[0]) // 2, ctx=ctx)
+        y0 = nd.full((n,), (H - self.crop[1]) // 2, ctx=ctx)
+        return _crop_resize(x, x0, y0, w, h, self.size, self.layout)
+
+class BatchRandomChoiceAug(object):
+    """apply one augmenter per sample, drawn from `augs` with probabilities
+    proportional to `weights`; each augmenter runs once on its share of the batch"""
+    def __init__(self, augs, weights=None):
+        self.augs = augs
+        weights = np.ones(len(augs)) if weights is None else np.asarray(weights, dtype='float64')
+        self.p = weights / weights.sum()
+
+    def __call__(self, x):
+        choice = np.random.choice(len(self.augs), size=x.shape[0], p=self.p)
+        order = np.argsort(choice, kind='stable')
+        outs = []
+        for k, aug in enumerate(self.augs):
+            idx = order[choice[order] == k]
+            if len(idx):
+                outs.append(aug(nd.take(x, nd.array(idx, ctx=x.context), axis=0)))
+        out = nd.concat(*outs, dim=0)
+        return nd.take(out, nd.array(np.argsort(order), ctx=x.context), axis=0)
+
+def sar_augs(layout='NHWC'):
+    """(copies, augmenter) recipe behind the 32x augmented training set"""
+    return [
+        (4, BatchHorizontalFlipAug(.5, layout)),
+        (9, BatchRandomSizedCropAug((75, 75), .75, (.8, 1.2), layout)),
+        (9, BatchBrightnessJitterAug(.1)),
+        (9, BatchRandomCropAug((50, 50), (75, 75), layout)),
+        (1, BatchCenterCropAug((50, 50), (75, 75), layout)),
+    ]
+
+def augment_batch(x, recipe=None):
+    """expand an NHWC batch into sum(copies) normalized augmented copies,
+    laid out copy-major so labels line up with nd.tile(label, copies)"""
+    recipe = recipe or sar_augs()
+    datas = [batch_img_norm(aug(nd.tile(x, reps=(k, 1, 1, 1)))) for k, aug in recipe]
+    return nd.concat(*datas, dim=0), sum(k for k, _ in recipe)
+
+TTA_VIEWS = ('orig', 'hflip', 'vflip', 'hvflip', 'center')
+
+def tta_views(x, views=('orig', 'hflip'), layout='NCHW'):
+    """stack the test-time views of a normalized batch into one batch of
+    len(views) * N samples, view-major. 'center' is the central 2/3 crop
+    resized back, re-normalized as the training crops are"""
+    h_axis, w_axis = (2, 3) if layout == 'NCHW' else (1, 2)
+    H, W = _hw(x, layout)
+    out = []
+    for v in views:
+        if v == 'orig':
+            out.append(x)
+        elif v == 'hflip':
+            out.append(nd.flip(x, axis=w_axis))
+        elif v == 'vflip':
+            out.append(nd.flip(x, axis=h_axis))
+        elif v == 'hvflip':
+            out.append(nd.flip(nd.flip(x, axis=h_axis), axis=w_axis))
+        elif v == 'center':
+            crop = BatchCenterCropAug((W * 2 // 3, H * 2 // 3), (W, H), layout)
+            out.append(batch_img_norm(crop(x)))
+        else:
+            raise ValueError('unknown TTA view %r, expected one of %s' % (v, ', '.join(TTA_VIEWS)))
+    return nd.concat(*out, dim=0) if len(out) > 1 else out[0]
+
+def tta_mean(prob, k):
+    """average view-major outputs of tta_views back to one row per sample"""
+    if k == 1:
+        return prob
+    return prob.reshape((k, -1) + prob.shape[1:]).mean(axis=0)
+
+def online_augs(layout='NHWC', recipe=None):
+    """DataLoader augs that draw each sample's augmenter with the same odds as
+    the materialized recipe, followed by per-sample normalization"""
+    recipe = recipe or sar_augs(layout)
+    return [BatchRandomChoiceAug([aug for _, aug in recipe], [k for k, _ in recipe]),
+            batch_img_norm]
+
+def _trainer_states(trainer):
+    """serialized optimizer states, as Trainer.save_states would write them"""
+    if not trainer._kv_initialized:
+        trainer._init_kvstore()
+    if trainer._params_to_init:
+        trainer._init_params()
+    if trainer._update_on_kvstore:
+        return trainer._kvstore._updater.get_states(dump_optimizer=True)
+    return trainer._updaters[0].get_states(dump_optimizer=True)
+
+def resolve_shapes(block, x):
+    """create the deferred parameters of `block` by running `x` through it, in
+    training mode: an inference forward leaves the conv weights in MKLDNN
+    layout, which dist kvstore init rejects"""
+    with autograd.train_mode():
+        block(x)
+
+class Checkpointer(object):
+    """write parameters, optimizer and RNG state to `directory`/epoch_NNNN from a
+    background thread, keeping the `keep_last` newest and `keep_best` lowest-score"""
+    def __init__(self, directory, keep_last=3, keep_best=3, info=None):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.info = info
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.index = []
+        index_file = os.path.join(directory, 'index.json')
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                self.index = json.load(f)
+        self._error = None
+        # at most one snapshot waits while another is being written
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, epoch, blocks, trainer=None, score=None, extra=None, pin=None):
+        """queue a checkpoint of `blocks` ({name: block}) and `trainer`;
+        lower score is better (validation logloss). The checkpoint of epoch
+        `pin` is kept whatever its score"""
+        if self._error is not None:
+            raise self._error
+        params = {}
+        for name, block in blocks.items():
+            for pname, p in block._collect_params_with_prefix().items():
+                params['%s:%s' % (name, pname)] = p._reduce()
+        states = _trainer_states(trainer) if trainer is not None else None
+        meta = {'epoch': epoch, 'score': score, 'extra': extra, 'info': self.info,
+                'np_random': np.random.get_state(), 'random': random.getstate()}
+        _reseed_mx()
+        self._queue.put((epoch, score, params, states, meta, pin))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, epoch, score, params, states, meta, pin):
+        name = 'epoch_%04d' % epoch
+        path = os.path.join(self.directory, name)
+        tmp = path + '.tmp'
+        for d in (tmp, path):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+        os.makedirs(tmp)
+        nd.save(os.path.join(tmp, 'params'), params)
+        if states is not None:
+            with open(os.path.join(tmp, 'trainer.states'), 'wb') as f:
+                f.write(states)
+        with open(os.path.join(tmp, 'meta.pkl'), 'wb') as f:
+            pickle.dump(meta, f)
+        os.rename(tmp, path)
+
+        self.index = [c for c in self.index if c['name'] != name]
+        self.index.append({'name': name, 'epoch': epoch, 'score': score})
+        keep = set(c['name'] for c in sorted(self.index, key=lambda c: c['epoch'])[-self.keep_last:]) \
+            if self.keep_last else set()
+        scored = [c for c in self.index if c['score'] is not None]
+        keep.update(c['name'] for c in sorted(scored, key=lambda c: c['score'])[:self.keep_best])
+        if pin is not None:
+            keep.add('epoch_%04d' % pin)
+        for c in self.index:
+            if c['name'] not in keep and os.path.exists(os.path.join(self.directory, c['name'])):
+                shutil.rmtree(os.path.join(self.directory, c['name']))
+        self.index = [c for c in self.index if c['name'] in keep]
+        with open(os.path.join(self.directory, 'index.json.tmp'), 'w') as f:
+            json.dump(self.index, f)
+        os.rename(os.path.join(self.directory, 'index.json.tmp'),
+                  os.path.join(self.directory, 'index.json'))
+
+    def wait(self):
+        """block until every queued checkpoint is on disk"""
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def resolve(self, which):
+        """path of the 'latest' or 'best' checkpoint, or `which` itself"""
+        self.wait()
+        if which not in ('latest', 'best'):
+            return which
+        if which == 'latest':
+            cands = sorted(self.index, key=lambda c: c['epoch'])
+        else:
+            cands = sorted([c for c in self.index if c['score'] is not None],
+                           key=lambda c: c['score'], reverse=True)
+        return os.path.join(self.directory, cands[-1]['name']) if cands else None
+
+    def meta(self, which):
+        """the meta dict of a checkpoint, without restoring anything"""
+        with open(os.path.join(self.resolve(which), 'meta.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+    def load(self, which, blocks, trainer=None):
+        """restore a checkpoint into `blocks` and `trainer` and return its
+        meta dict; training resumes at meta['epoch'] + 1"""
+        path = self.resolve(which)
+        params = nd.load(os.path.join(path, 'params'))
+        for name, block in blocks.items():
+            for pname, p in block._collect_params_with_prefix().items():
+                p.set_data(params['%s:%s' % (name, pname)])
+        states = os.path.join(path, 'trainer.states')
+        if trainer is not None and os.path.exists(states):
+            trainer.load_states(states)
+        meta = self.meta(path)
+        np.random.set_state(meta['np_random'])
+        random.setstate(meta['random'])
+        _reseed_mx()
+        return meta
+
+def _reseed_mx():
+    # MXNet's generators cannot be saved, so at every checkpoint they are
+    # reseeded from the numpy stream, which is saved
+    mx.random.seed(np.random.randint(2**31))
+
+_BWD_BULK = 'MXNET_EXEC_BULK_EXEC_MAX_NODE_TRAIN_BWD'
+
+# backward ops not named _backward_<forward op>
+_BACKWARD_OF = {'_backward_copy': ('Flatten', 'Reshape', 'reshape', '_copy')}
+
+def unbulk_backward():
+    """re-exec with backward bulking off so LayerProfiler sees every backward op;
+    MXNet reads it only at startup, so the whole run trains slower"""
+    if os.environ.get(_BWD_BULK) != '0':
+        os.environ[_BWD_BULK] = '0'
+        sys.stdout.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+def _trace_ops(path):
+    """(name, start, end) in seconds of every operator in an MXNet profiler
+    dump, in start order"""
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    open_ops, ops = {}, []
+    for e in events:
+        if e.get('cat') != 'operator':
+            continue
+        key = (e.get('tid'), e['name'])
+        if e['ph'] == 'B':
+            open_ops.setdefault(key, []).append(e['ts'] / 1e6)
+        elif e['ph'] == 'E' and open_ops.get(key):
+            ops.append((e['name'], open_ops[key].pop(), e['ts'] / 1e6))
+    return sorted(ops, key=lambda o: o[1])
+
+class LayerProfiler(object):
+    """time forward and backward of every layer of `blocks` ({name: block}) over
+    `num_batches` training batches into `<out>.txt` and `<out>.trace.json`"""
+    def __init__(self, blocks, num_batches=20, warmup=1, out='./profile'):
+        self.blocks = blocks
+        self.num_batches = num_batches
+        self.warmup = warmup
+        self.out = out
+        self.events = []
+        self.batches = 0
+        self._patched = []
+        self._hybrid = []
+        self._forward = []
+        self._batch_starts = []
+        self._tracing = False
+        self._bulked = False
+        self._t0 = time()
+
+    def _layers(self, prefix, block):
+        children = list(block._children.items())
+        if isinstance(block, (nn.Sequential, nn.HybridSequential)) or \
+                (len(children) == 1 and not block._reg_params):
+            for name, child in children:
+                for layer in self._layers('%s.%s' % (prefix, name), child):
+                    yield layer
+        else:
+            yield prefix, block
+
+    def attach(self):
+        for name, block in self.blocks.items():
+            for b in _all_blocks(block):
+                if isinstance(b, gluon.HybridBlock):
+                    self._hybrid.append((b, b._active, b._flags))
+            block.hybridize(False)
+            for path, layer in self._layers(name, block):
+                self._patch(layer, '%s(%s)' % (path, type(layer).__name__))
+        root = next(iter(self.blocks.values()))
+        forward = root.forward
+        def counted(*args):
+            if autograd.is_recording():
+                if self.batches >= self.num_batches:
+                    self.detach()
+                    self.report()
+                elif self.warmup > 0:
+                    self.warmup -= 1
+                else:
+                    # keep the previous step's backward and update out of the first layer
+                    nd.waitall()
+                    if not self._tracing:
+                        mx.profiler.set_config(profile_imperative=True, aggregate_stats=False,
+                                               filename=self.out + '.mxnet.json')
+                        mx.profiler.set_state('run')
+                        self._tracing = True
+                    self.batches += 1
+                    self._batch_starts.append(time())
+            return forward(*args)
+        root.forward = counted
+        self._patched.append(root)
+        return self
+
+    def _patch(self, layer, name):
+        forward = layer.forward
+        def timed(x, *args):
+            if not autograd.is_recording() or not isinstance(x, nd.NDArray) or not self.batches:
+                return forward(x, *args)
+            x.wait_to_read()
+            start = time()
+            out = forward(x, *args)
+            if isinstance(out, nd.NDArray):
+                out.wait_to_read()
+                self._forward.append((name, start, time()))
+            return out
+        layer.forward = timed
+        self._patched.append(layer)
+
+    def _attribute(self, ops):
+        """per-layer forward and backward events of every timed batch"""
+        bounds = self._batch_starts + [float('inf')]
+        for b in range(len(self._batch_starts)):
+            lo, hi = bounds[b], bounds[b + 1]
+            layers = [w for w in self._forward if lo <= w[1] < hi]
+            if not layers:
+                continue
+            fwd_end = layers[-1][2]
+            batch_ops = [o for o in ops if lo <= o[1] < hi]
+            self._bulked |= any(op == 'ImperativeBulk' for op, _, _ in batch_ops)
+            # the ops each layer ran; backward ops of one layer need not come
+            # in reverse forward order, so they are matched by count
+            ran = [collections.Counter() for _ in layers]
+            for op, start, end in batch_ops:
+                if start > fwd_end:
+                    break
+                for i, (_, s, e) in enumerate(layers):
+                    if s <= start and end <= e:
+                        ran[i][op] += 1
+                        break
+            cur = len(layers) - 1
+            spans = collections.OrderedDict()
+            for op, start, end in batch_ops:
+                if start <= fwd_end or not op.startswith('_backward_'):
+                    continue
+                names = _BACKWARD_OF.get(op, (op[len('_backward_'):],))
+                i = cur
+                while i >= 0 and not any(ran[i][n] for n in names):
+                    i -= 1
+                if i < 0:
+                    continue
+                cur = i
+                ran[i][[n for n in names if ran[i][n]][0]] -= 1
+                span = spans.setdefault(layers[i][0], [start, 0.])
+                span[1] += end - start
+            for name, start, end in layers:
+                self.events.append((name, 'forward', start - self._t0, end - start))
+            for name, (start, busy) in spans.items():
+                self.events.append((name, 'backward', start - self._t0, busy))
+
+    def detach(self):
+        """put the blocks back as they were"""
+        nd.waitall()
+        for layer in self._patched:
+            del layer.forward
+        self._patched = []
+        for b, active, flags in self._hybrid:
+            b._active, b._flags = active, flags
+            b._clear_cached_op()
+        self._hybrid = []
+        if self._tracing:
+            mx.profiler.set_state('stop')
+            mx.profiler.dump()
+            self._tracing = False
+            path = self.out + '.mxnet.json'
+            self._attribute(_trace_ops(path))
+            os.remove(path)
+
+    def close(self):
+        """detach and report if training ended before num_batches"""
+        if self._patched:
+            self.detach()
+            self.report()
+
+    def table(self):
+        """(layer, forward ms, backward ms) per batch, slowest first"""
+        totals = collections.OrderedDict()
+        for name, phase, _, dur in self.events:
+            t = totals.setdefault(name, {'forward': 0., 'backward': 0.})
+            t[phase] += dur * 1000. / max(self.batches, 1)
+        rows = [(name, t['forward'], t['backward']) for name, t in totals.items()]
+        return sorted(rows, key=lambda r: r[1] + r[2], reverse=True)
+
+    def report(self):
+        rows = self.table()
+        total = sum(f + b for _, f, b in rows) or 1.
+        lines = ['%-40s %10s %10s %10s %6s' % ('layer', 'fwd ms', 'bwd ms', 'total ms', '%')]
+        for name, f, b in rows:
+            lines.append('%-40s %10.2f %10.2f %10.2f %6.1f' % (name, f, b, f + b, 100. * (f + b) / total))
+        lines.append('per batch over %d batches' % self.batches)
+        if self._bulked:
+            lines.append('some backward ops ran in bulked segments and are missing; '
+                         'set %s=0 before starting (utils.unbulk_backward)' % _BWD_BULK)
+        text = '\n'.join(lines)
+        with open(self.out + '.txt', 'w') as f:
+            f.write(text + '\n')
+        trace = [{'name': name, 'cat': phase, 'ph': 'X', 'pid': 0,
+                  'tid': 0 if phase == 'forward' else 1,
+                  'ts': ts * 1e6, 'dur': dur * 1e6} for name, phase, ts, dur in self.events]
+        with open(self.out + '.trace.json', 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        print(text)
+        print('wrote %s.txt, %s.trace.json' % (self.out, self.out))
+
+def _all_blocks(block):
+    yield block
+    for child in block._children.values():
+        for b in _all_blocks(child):
+            yield b
 
 def load_data_fashion_mnist(batch_size, resize=None, root="~/.mxnet/datasets/fashion-mnist"):
     """download the fashion mnist dataest and then load into memory"""
@@ -106,10 +909,161 @@ def try_all_gpus():
         ctx_list = [mx.cpu()]
     return ctx_list
 
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def cpu_list():
+    """the cores this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+def popen_pinned(cmd, cores=None, threads=None, env=None, **kwargs):
+    """Popen `cmd` limited to `threads` OpenMP threads and pinned to `cores`
+    (when given and supported), so concurrent MXNet processes do not
+    oversubscribe the host"""
+    env = dict(os.environ if env is None else env)
+    if threads:
+        env.update(OMP_NUM_THREADS=str(threads), MXNET_CPU_WORKER_NTHREADS='1')
+    preexec = None
+    if cores and hasattr(os, 'sched_setaffinity'):
+        preexec = lambda: os.sched_setaffinity(0, cores)
+    return subprocess.Popen(cmd, env=env, preexec_fn=preexec, **kwargs)
+
+def launch_local(num_workers, argv, threads=None, num_servers=1, pin=True):
+    """run `argv` as num_workers dist_sync workers plus scheduler and servers on
+    this host; returns the first non-zero worker exit code"""
+    cores = cpu_list()
+    threads = threads or max(len(cores) // num_workers, 1)
+    env = dict(os.environ, DMLC_PS_ROOT_URI='127.0.0.1', DMLC_PS_ROOT_PORT=str(_free_port()),
+               DMLC_NUM_WORKER=str(num_workers), DMLC_NUM_SERVER=str(num_servers),
+               DMLC_NODE_HOST='127.0.0.1')
+    # importing mxnet with DMLC_ROLE set runs the scheduler/server loop
+    others = [subprocess.Popen([sys.executable, '-c', 'import mxnet'], env=dict(env, DMLC_ROLE=role))
+              for role in ['scheduler'] + ['server'] * num_servers]
+    workers = []
+    # so that killing the launcher also kills its children, in the finally below
+    on_term = signal.signal(signal.SIGTERM, lambda *a: sys.exit(128 + signal.SIGTERM))
+    try:
+        for rank in range(num_workers):
+            block = cores[rank * threads: (rank + 1) * threads] if pin else None
+            workers.append(popen_pinned([sys.executable] + list(argv), block, threads,
+                                        dict(env, DMLC_ROLE='worker')))
+        # a worker or server that dies leaves the others blocked in a push/pull
+        # (or in ps-lite's finalize) forever, so the first failure ends the run
+        while any(w.poll() is None for w in workers):
+            if any(w.poll() for w in workers) or any(p.poll() for p in others):
+                break
+            sleep(1)
+        else:
+            for p in others:
+                try:
+                    p.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    pass
+    finally:
+        signal.signal(signal.SIGTERM, on_term)
+        for p in workers + others:
+            if p.poll() is None:
+                p.kill()
+            p.wait()
+    codes = [w.returncode for w in workers]
+    # a worker that failed by itself comes before the ones killed above
+    failed = [c for c in codes if c > 0] or [c for c in codes if c] or \
+        [p.returncode for p in others if p.returncode]
+    return failed[0] if failed else 0
+
+def dist_kvstore():
+    """(kvstore, rank, num_workers) inside a launch_local worker, else (None, 0, 1)"""
+    if os.environ.get('DMLC_ROLE') != 'worker':
+        return None, 0, 1
+    kv = mx.kv.create('dist_sync')
+    # an uncaught error would otherwise hang in ps-lite's finalize at exit,
+    # leaving launch_local waiting on a worker that never ends
+    def exit_now(*exc):
+        sys.__excepthook__(*exc)
+        sys.stderr.flush()
+        os._exit(1)
+    sys.excepthook = exit_now
+    return kv, kv.rank, kv.num_workers
+
+def init_dist_params(trainer):
+    """start every dist worker from rank 0's parameters; call before the first
+    step, else a late weight pull can return the first summed gradient"""
+    if not trainer._kv_initialized:
+        trainer._init_kvstore()
+    if trainer._params_to_init:
+        trainer._init_params()
+    nd.waitall()
+    trainer._kvstore._barrier()
+
 def SGD(params, lr):
     for param in params:
         param[:] = param - lr * param.grad
 
+class Metrics(object):
+    """running loss / accuracy sums kept on the device. The host only waits
+    on them every `sync_every` updates, which bounds how far the engine
+    queue runs ahead (0 disables it), and when get() is called"""
+    def __init__(self, ctx=mx.cpu(), sync_every=0):
+        self.ctx = ctx
+        self.sync_every = sync_every
+        self.reset()
+
+    def reset(self):
+        self._loss = nd.zeros((1,), ctx=self.ctx)
+        self._correct = nd.zeros((1,), ctx=self.ctx)
+        self.n = 0
+        self.updates = 0
+
+    def update(self, loss, output=None, label=None):
+        self._loss += nd.sum(loss).as_in_context(self.ctx)
+        if output is not None:
+            self._correct += nd.sum(output.argmax(axis=1) == label).as_in_context(self.ctx)
+        self.n += loss.shape[0]
+        self.updates += 1
+        if self.sync_every and self.updates % self.sync_every == 0:
+            self._loss.wait_to_read()
+
+    def get(self):
+        """return (mean loss, accuracy) over the samples seen since reset"""
+        n = max(self.n, 1)
+        return self._loss.asscalar() / n, self._correct.asscalar() / n
+
+@mx.optimizer.register
+class MultiAdam(mx.optimizer.Adam):
+    """Adam that updates up to `aggregate_num` parameters with one fused
+    multi-tensor op, bias correction folded into each parameter's lr"""
+    def __init__(self, aggregate_num=64, **kwargs):
+        super(MultiAdam, self).__init__(**kwargs)
+        self.aggregate_num = aggregate_num
+
+    def update(self, index, weight, grad, state):
+        if not isinstance(index, (tuple, list)):
+            return super(MultiAdam, self).update(index, weight, grad, state)
+        if self.wd or any(w.stype != 'default' for w in weight):
+            # multi_adamw decouples weight decay, keep plain Adam semantics
+            for i, w, g, s in zip(index, weight, grad, state):
+                super(MultiAdam, self).update(i, w, g, s)
+            return
+        self._update_count(index)
+        lrs = self._get_lrs(index)
+        for k, i in enumerate(index):
+            t = self._index_update_count[i]
+            lrs[k] *= math.sqrt(1. - self.beta2**t) / (1. - self.beta1**t)
+        kwargs = {'beta1': self.beta1, 'beta2': self.beta2, 'epsilon': self.epsilon}
+        if self.clip_gradient:
+            kwargs['clip_gradient'] = self.clip_gradient
+        means, variances = zip(*state)
+        nd.contrib.multi_adamw_update(list(weight), list(grad), list(means), list(variances),
+                                      rescale_grad=self.rescale_grad, lrs=lrs,
+                                      wds=[0.] * len(index), etas=[1.] * len(index),
+                                      out=list(weight), **kwargs)
+
 def accuracy(output, label):
     return nd.mean(output.argmax(axis=1)==label).asscalar()
 
@@ -136,31 +1090,416 @@ def cross_entropy(yhat, y):
 
 
 def evaluate_accuracy(data_iter, net, ctx=[mx.cpu()]):
-    acc = .0
-    total_loss = .0
-    n = 0
+    metrics = Metrics(ctx)
     for data, label in data_iter:
         data = data.as_in_context(ctx)
         label = label.as_in_context(ctx)
         output = net(data)
         prob = softmax(output)
         loss = cross_entropy(prob, label)
-        total_loss += nd.sum(loss).asscalar()
-        n += loss.shape[0]
-        acc += accuracy(output, label)
-    return acc / len(data_iter), total_loss / n
-
-def predict(data_iter, net, filename, ctx=[mx.cpu()]):
-    
-    outf = open(filename, 'w')
-    for data, iden in data_iter:
-        data = data.as_in_context(ctx)
-        output = net(data)
-        # print(output)
-        prob = softmax(output)
-        for i in range(len(iden)):
-            # print(prob[i])
-            outf.write('%s,%f\n' % (iden[i], prob[i][1].asscalar()))
+        metrics.update(loss, output, label)
+    loss, acc = metrics.get()
+    return acc, loss
+
+class PredictionWriter(object):
+    """write (id, is_iceberg) CSV rows batch by batch, plus `<filename>.npz`
+    with binary=True; with keep=False the rows are not retained"""
+    def __init__(self, filename, binary=False, keep=True):
+        self.filename = filename
+        self.binary = binary
+        self.keep = keep or binary
+        self._ids, self._probs = [], []
+        self._f = open(filename, 'w')
+        self._f.write('id,is_iceberg\n')
+
+    def write(self, ids, prob):
+        prob = prob.asnumpy() if isinstance(prob, nd.NDArray) else np.asarray(prob)
+        self._f.write(''.join(['%s,%f\n' % row for row in zip(ids, prob)]))
+        if not self.keep:
+            return
+        self._ids.append(np.asarray(ids, dtype='U'))
+        self._probs.append(prob.astype('float32'))
+
+    def result(self):
+        return (np.concatenate(self._ids) if self._ids else np.array([], dtype='U'),
+                np.concatenate(self._probs) if self._probs else np.array([], dtype='float32'))
+
+    def close(self):
+        self._f.close()
+        if self.binary:
+            ids, probs = self.result()
+            np.savez(self.filename + '.npz', id=ids, is_iceberg=probs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def predict(data_iter, net, filename, ctx=[mx.cpu()], binary=False, tta=None):
+    """write the iceberg probability of every test batch; with `tta` (a list
+    of TTA_VIEWS) all views of a batch go through the net in one forward pass
+    and their probabilities are averaged"""
+    with PredictionWriter(filename, binary) as writer:
+        for data, iden in data_iter:
+            data = data.as_in_context(ctx)
+            if tta:
+                data = tta_views(data, tta)
+            output = net(data)
+            prob = tta_mean(softmax(output), len(tta) if tta else 1)
+            writer.write(iden, prob[:, 1])
+    return writer.result()
+
+def load_exported(prefix, ctx=mx.cpu(), epoch=0):
+    """load a net written by HybridBlock.export (such as the INT8 model from
+    quantize.py) as a SymbolBlock that predict can run"""
+    return gluon.SymbolBlock.imports('%s-symbol.json' % prefix, ['data'],
+                                     '%s-%04d.params' % (prefix, epoch), ctx=ctx)
+
+class PredictionScheduler(object):
+    """call `predict_fn(filename)` every `every` epochs, on a new best score
+    and from `finish`, each epoch at most once; average=True writes `<prefix>.avg`"""
+    def __init__(self, predict_fn, prefix='./predict_result/result', every=0,
+                 on_best=True, final=True, average=False, start=0, binary=False):
+        self.predict_fn = predict_fn
+        self.prefix = prefix
+        self.every = every
+        self.on_best = on_best
+        self.final = final
+        self.average = average
+        self.start = start
+        self.binary = binary
+        self.best = None
+        self.predicted = set()
+        self.ids, self.mean, self.count = None, None, 0
+
+    def step(self, epoch, score=None):
+        """call after validating `epoch`; returns True if it predicted"""
+        improved = score is not None and (self.best is None or score < self.best)
+        if improved:
+            self.best = score
+        if epoch < self.start:
+            return False
+        if epoch in self.predicted:
+            return False
+        if (self.every and (epoch + 1) % self.every == 0) or (self.on_best and improved):
+            self._run(epoch)
+            return True
+        return False
+
+    def finish(self, epoch):
+        """predict the final snapshot if `step` has not already and write the average"""
+        if self.final and epoch not in self.predicted:
+            self._run(epoch)
+        if self.average and self.count:
+            with PredictionWriter(self.prefix + '.avg', self.binary) as writer:
+                writer.write(self.ids, self.mean)
+
+    def _run(self, epoch):
+        ids, probs = self.predict_fn('%s.epoch_%d' % (self.prefix, epoch))
+        self.predicted.add(epoch)
+        if self.average:
+            if self.mean is None:
+                self.ids, self.mean = ids, np.zeros(len(probs), dtype='float64')
+            self.count += 1
+            self.mean += (probs - self.mean) / self.count
+
+
+class LRSchedule(object):
+    """learning rate per (fractional) epoch, 'constant', 'step', 'cosine' or
+    'plateau' after a linear warmup; `update` every batch, `step` every epoch"""
+    KINDS = ('constant', 'step', 'cosine', 'plateau')
+
+    def __init__(self, base_lr, kind='constant', epochs=100, warmup=0, step=30, factor=0.1,
+                 patience=5, min_lr=0., threshold=1e-4):
+        if kind not in self.KINDS:
+            raise ValueError('unknown lr schedule %r' % kind)
+        self.base_lr = base_lr
+        self.kind = kind
+        self.epochs = epochs
+        self.warmup = warmup
+        self.step_epochs = step
+        self.factor = factor
+        self.patience = patience
+        self.min_lr = min_lr
+        self.threshold = threshold
+        self.plateau_lr = base_lr
+        self.best = None
+        self.bad = 0
+
+    def lr(self, epoch):
+        if self.kind == 'step':
+            lr = self.base_lr * self.factor ** (int(epoch) // self.step_epochs)
+        elif self.kind == 'cosine':
+            t = min(max(epoch - self.warmup, 0.) / max(self.epochs - self.warmup, 1), 1.)
+            lr = self.min_lr + (self.base_lr - self.min_lr) * (1 + math.cos(math.pi * t)) / 2
+        elif self.kind == 'plateau':
+            lr = self.plateau_lr
+        else:
+            lr = self.base_lr
+        if epoch < self.warmup:
+            lr *= (epoch + 1.) / (self.warmup + 1.)
+        return max(lr, self.min_lr)
+
+    def update(self, trainer, epoch):
+        lr = self.lr(epoch)
+        if lr != trainer.learning_rate:
+            trainer.set_learning_rate(lr)
+
+    def step(self, epoch, score):
+        """call after validating `epoch`; only 'plateau' reacts to it"""
+        if self.kind != 'plateau' or epoch + 1 < self.warmup:
+            return
+        if self.best is None or score < self.best - self.threshold:
+            self.best, self.bad = score, 0
+            return
+        self.bad += 1
+        if self.bad >= self.patience:
+            self.plateau_lr = max(self.plateau_lr * self.factor, self.min_lr)
+            self.bad = 0
+            print('epoch %d: no improvement in %d epochs, lr reduced to %g'
+                  % (epoch, self.patience, self.plateau_lr))
+
+    def state(self):
+        return {'plateau_lr': self.plateau_lr, 'best': self.best, 'bad': self.bad}
+
+    def load_state(self, state):
+        self.plateau_lr, self.best, self.bad = state['plateau_lr'], state['best'], state['bad']
+
+
+class EarlyStopping(object):
+    """stop once the validation score (lower is better) has not improved by
+    `min_delta` for `patience` epochs. A copy of the parameters of the best
+    epoch is kept in memory and put back by `restore`"""
+    def __init__(self, patience=10, min_delta=0.):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = None
+        self.best_epoch = None
+        self.bad = 0
+        self.params = None
+
+    def step(self, epoch, score, blocks):
+        """call after validating `epoch` with the trained blocks ({name:
+        block}); returns False when training should stop"""
+        if self.best is None or score < self.best - self.min_delta:
+            self.best, self.best_epoch, self.bad = score, epoch, 0
+            self.params = dict(('%s:%s' % (name, pname), p._reduce())
+                               for name, block in blocks.items()
+                               for pname, p in block._collect_params_with_prefix().items())
+            return True
+        self.bad += 1
+        return self.bad < self.patience
+
+    def restore(self, blocks, checkpointer=None):
+        """load best_epoch's parameters into `blocks`, from its checkpoint after a
+        resume (the checkpointer's 'best' can differ with min_delta)"""
+        if self.params is None:
+            if checkpointer is None or self.best_epoch is None:
+                return False
+            path = os.path.join(checkpointer.directory, 'epoch_%04d' % self.best_epoch)
+            if not os.path.exists(path):
+                return False
+            checkpointer.load(path, blocks)
+        else:
+            for name, block in blocks.items():
+                for pname, p in block._collect_params_with_prefix().items():
+                    p.set_data(self.params['%s:%s' % (name, pname)])
+        print('restored the parameters of epoch %d (score %f)' % (self.best_epoch, self.best))
+        return True
+
+    def state(self):
+        return {'best': self.best, 'best_epoch': self.best_epoch, 'bad': self.bad}
+
+    def load_state(self, state):
+        self.best, self.best_epoch, self.bad = state['best'], state['best_epoch'], state['bad']
+
+class EpochHooks(object):
+    """the resume, end-of-epoch and final restore/prediction bookkeeping of
+    train.py's and resnet.py's loops; any of the helpers may be None"""
+    def __init__(self, blocks, trainer, checkpointer=None, scheduler=None, lr_schedule=None,
+                 early_stop=None, on_epoch=None):
+        self.blocks = blocks
+        self.trainer = trainer
+        self.checkpointer = checkpointer
+        self.scheduler = scheduler
+        self.lr_schedule = lr_schedule
+        self.early_stop = early_stop
+        self.on_epoch = on_epoch
+
+    def resume(self, which):
+        """load checkpoint `which` with the helpers' states; returns the epoch to continue from"""
+        meta = self.checkpointer.load(which, self.blocks, self.trainer)
+        extra = meta['extra'] or {}
+        if self.lr_schedule is not None and extra.get('lr_schedule'):
+            self.lr_schedule.load_state(extra['lr_schedule'])
+        if self.early_stop is not None and extra.get('early_stop'):
+            self.early_stop.load_state(extra['early_stop'])
+        print('resumed from %s at epoch %d' % (which, meta['epoch'] + 1))
+        return meta['epoch'] + 1
+
+    def end_epoch(self, epoch, score):
+        """call after validating `epoch`; returns False when training should stop"""
+        if self.lr_schedule is not None:
+            self.lr_schedule.step(epoch, score)
+        go_on = self.early_stop is None or self.early_stop.step(epoch, score, self.blocks)
+        if self.checkpointer is not None:
+            extra = {'lr_schedule': self.lr_schedule and self.lr_schedule.state(),
+                     'early_stop': self.early_stop and self.early_stop.state()}
+            self.checkpointer.save(epoch, self.blocks, self.trainer, score=score, extra=extra,
+                                   pin=self.early_stop and self.early_stop.best_epoch)
+        if self.scheduler is not None:
+            self.scheduler.step(epoch, score)
+        if not go_on:
+            print('no improvement in %d epochs, stopping' % self.early_stop.patience)
+        if self.on_epoch is not None and self.on_epoch(epoch, score) is False:
+            go_on = False
+        return go_on
+
+    def finish(self, last):
+        """after the last trained epoch: restore the best one and make the final prediction"""
+        if self.early_stop is not None and self.early_stop.restore(self.blocks, self.checkpointer):
+            last = self.early_stop.best_epoch  # the final prediction is of the restored epoch
+        if self.scheduler is not None:
+            self.scheduler.finish(last)
+
+
+def parse_train_args(parser, epochs=100):
+    """add the options train.py and resnet.py share to `parser`, then parse
+    and check the command line"""
+    parser.add_argument('--online-aug', action='store_true',
+                        help='augment each training batch on the fly instead of materializing 32 copies')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='worker processes preparing training batches')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='ready batches queued ahead of the training loop')
+    parser.add_argument('--hybridize', action='store_true',
+                        help='run the model as a static graph')
+    parser.add_argument('--checkpoint-dir', help='write full resumable checkpoints here')
+    parser.add_argument('--keep-last', type=int, default=3)
+    parser.add_argument('--keep-best', type=int, default=3)
+    parser.add_argument('--resume', help="checkpoint path, 'latest' or 'best'")
+    parser.add_argument('--predict-every', type=int, default=0,
+                        help='predict the test set every k epochs (0: only on triggers below)')
+    parser.add_argument('--no-predict-best', action='store_true',
+                        help='do not predict when validation loss reaches a new best')
+    parser.add_argument('--predict-average', action='store_true',
+                        help='also write the mean of all predicted snapshots')
+    parser.add_argument('--tta', nargs='+', choices=TTA_VIEWS,
+                        help='average test predictions over these views, e.g. orig hflip vflip')
+    parser.add_argument('--profile', type=int, metavar='N',
+                        help='time every layer over N training batches and write a report; backward '
+                             'bulking stays off, so the whole run trains slower')
+    parser.add_argument('--profile-out', default='./profile',
+                        help='prefix of the .txt table and .trace.json chrome trace')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='data-parallel training processes on this host')
+    parser.add_argument('--threads', type=int,
+                        help='OpenMP threads per worker (default: cores // workers)')
+    parser.add_argument('--seed', type=int, help='seed of the split and initialization')
+    parser.add_argument('--lr', type=float, default=.001)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--conv-dropout', type=float, default=.2,
+                        help='dropout after the first conv of each block')
+    parser.add_argument('--dropout', type=float, default=.5,
+                        help='dropout after each pooling and dense layer')
+    parser.add_argument('--epochs', type=int, default=epochs)
+    parser.add_argument('--lr-schedule', choices=LRSchedule.KINDS, default='constant')
+    parser.add_argument('--warmup', type=float, default=0, help='epochs of linear lr warmup')
+    parser.add_argument('--lr-step', type=int, default=30, help='epochs between step decays')
+    parser.add_argument('--lr-factor', type=float, default=0.1, help='step/plateau decay factor')
+    parser.add_argument('--lr-patience', type=int, default=5,
+                        help='epochs without improvement before a plateau decay')
+    parser.add_argument('--min-lr', type=float, default=0.)
+    parser.add_argument('--early-stop', type=int, default=0, metavar='PATIENCE',
+                        help='stop after this many epochs without a better validation logloss '
+                             'and restore the best epoch (0 disables)')
+    parser.add_argument('--min-delta', type=float, default=0.,
+                        help='smallest logloss decrease that counts as an improvement')
+    args = parser.parse_args()
+    if args.workers > 1 and (args.early_stop or args.lr_schedule == 'plateau'):
+        # only rank 0 validates, so the other workers could not follow its decisions
+        parser.error('--early-stop and the plateau schedule need a single worker')
+    if args.batch_size % args.workers:
+        # every worker takes an equal share of the global batch
+        parser.error('--batch-size %d is not a multiple of --workers %d'
+                     % (args.batch_size, args.workers))
+    if args.resume is not None:
+        if not args.checkpoint_dir:
+            parser.error('--resume needs the --checkpoint-dir it was written to')
+        # the train/valid split is drawn from the seed, so a resumed run must
+        # reuse it or it would validate on chips it has trained on
+        if not os.path.isdir(args.checkpoint_dir):
+            parser.error('no checkpoint directory %s' % args.checkpoint_dir)
+        checkpointer = Checkpointer(args.checkpoint_dir)
+        if checkpointer.resolve(args.resume) is None:
+            parser.error('no checkpoint to resume in %s' % args.checkpoint_dir)
+        seed = (checkpointer.meta(args.resume).get('info') or {}).get('seed')
+        checkpointer.close()
+        if seed is None and args.seed is None:
+            parser.error('the checkpoint does not record its seed, pass the run\'s --seed')
+        if seed is not None and args.seed not in (None, seed):
+            parser.error('the checkpoint was trained with --seed %d' % seed)
+        args.seed = seed if seed is not None else args.seed
+    return args
+
+def split_indices(num):
+    """(train_idx, valid_idx) of a fresh shuffle of num chips, 1/16 of them held
+    out for validation. Seeding numpy as start_training does reproduces a run's split"""
+    idx = np.arange(num)
+    np.random.shuffle(idx)
+    split = num // 16
+    return idx[split:], idx[:split]
+
+def run_split(args, num, rank=0):
+    """split_indices, with rank 0 saving the held-out rows as valid_idx.npy in
+    the checkpoint directory (else model_out/) for quantize.py"""
+    train_idx, valid_idx = split_indices(num)
+    if rank == 0:
+        directory = args.checkpoint_dir or './model_out'
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, 'valid_idx.npy'), valid_idx)
+    return train_idx, valid_idx
+
+def prepare_caches(*paths):
+    """build the binary cache of each json once, before starting processes
+    that read it, so they all memory-map the same cache instead of decoding"""
+    for path in paths:
+        load_src_data(path)
+
+def start_training(args):
+    """process setup of a parse_train_args run: un-bulk backward for
+    --profile, relaunch as --workers processes (exiting with their status)
+    and seed. Returns (kvstore, rank, num_workers) of this process"""
+    if args.profile:
+        unbulk_backward()
+    kvstore, rank, num_workers = dist_kvstore()
+    if args.seed is None:
+        # drawn here so the checkpoints can record it (see train_helpers)
+        args.seed = np.random.randint(2**31)
+    if args.workers > 1 and kvstore is None:
+        prepare_caches('input/train.json', 'input/test.json')
+        # every worker must draw the same split, so they share a seed
+        sys.exit(launch_local(args.workers, sys.argv + ['--seed', str(args.seed)], args.threads))
+    np.random.seed(args.seed)
+    mx.random.seed(args.seed)
+    return kvstore, rank, num_workers
+
+def train_helpers(args, predict_fn):
+    """(checkpointer, scheduler, lr_schedule, early_stop) as the
+    parse_train_args options configure them; the checkpointer and early_stop
+    are None unless asked for"""
+    checkpointer = None
+    if args.checkpoint_dir:
+        checkpointer = Checkpointer(args.checkpoint_dir, args.keep_last, args.keep_best,
+                                    info={'seed': args.seed})
+    scheduler = PredictionScheduler(predict_fn, every=args.predict_every,
+                                    on_best=not args.no_predict_best, average=args.predict_average)
+    lr_schedule = LRSchedule(args.lr, args.lr_schedule, args.epochs, args.warmup, args.lr_step,
+                             args.lr_factor, args.lr_patience, args.min_lr)
+    early_stop = EarlyStopping(args.early_stop, args.min_delta) if args.early_stop else None
+    return checkpointer, scheduler, lr_schedule, early_stop
 
 
 # def evaluate_accuracy(data_iterator, net, ctx=[mx.cpu()]):
@@ -186,13 +1525,14 @@ def predict(data_iter, net, filename, ctx=[mx.cpu()]):
 #         acc.wait_to_read() # don't push too many operators into backend
 #     return acc.asscalar() / n, total_loss / n
 
-def train(train_data, test_data, net, loss, trainer, ctx, num_epochs, print_batches=None):
+def train(train_data, test_data, net, loss, trainer, ctx, num_epochs, print_batches=None,
+          sync_every=10):
     """Train a network"""
     print("Start training on ", ctx)
     if isinstance(ctx, mx.Context):
         ctx = [ctx]
     for epoch in range(num_epochs):
-        train_loss, train_acc, n, m = 0.0, 0.0, 0.0, 0.0
+        metrics = Metrics(ctx[0], sync_every)
         if isinstance(train_data, mx.io.MXDataIter):
             train_data.reset()
         start = time()
@@ -204,20 +1544,19 @@ def train(train_data, test_data, net, loss, trainer, ctx, num_epochs, print_batc
                 losses = [loss(yhat, y) for yhat, y in zip(outputs, label)]
             for l in losses:
                 l.backward()
-            train_acc += sum([(yhat.argmax(axis=1)==y).sum().asscalar()
-                              for yhat, y in zip(outputs, label)])
-            train_loss += sum([l.sum().asscalar() for l in losses])
+            for l, yhat, y in zip(losses, outputs, label):
+                metrics.update(l, yhat, y)
             trainer.step(batch_size)
-            n += batch_size
-            m += sum([y.size for y in label])
             if print_batches and (i+1) % print_batches == 0:
+                train_loss, train_acc = metrics.get()
                 print("Batch %d. Loss: %f, Train acc %f" % (
-                    n, train_loss/n, train_acc/m
+                    metrics.n, train_loss, train_acc
                 ))
 
-        test_acc = evaluate_accuracy(test_data, net, ctx)
+        train_loss, train_acc = metrics.get()
+        test_acc, _ = evaluate_accuracy(test_data, net, ctx[0])
         print("Epoch %d. Loss: %.3f, Train acc %.2f, Test acc %.2f Time %.1f sec" % (
-            epoch, train_loss/n, train_acc/m, test_acc, time() - start
+            epoch, train_loss, train_acc, test_acc, time() - start
         ))
 
 class Residual(nn.HybridBlock):